@@ -2,42 +2,118 @@
 Module for processing facturas ADO
 '''
 
-import io
+import os
 import re
+import time
+import datetime
 from pprint import pprint as pp
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-import PyPDF2
-from bs4 import BeautifulSoup
+import ledger
+import metrics
+import http_client
+import pdf_cache
 
 
 # Global vars
 RFC = 'IVE950901EI6'
-VALIDATE_URL = 'http://factura.grupoado.com.mx/jsp/validate.jsp'
-REGISTER_URL = 'http://factura.grupoado.com.mx/register.jsp'
-FACTURAR_URL = 'http://factura.grupoado.com.mx/facturar.jsp'
+# ADO's invoicing site, the pages below are relative to it
+FACTURA_URL = os.getenv('ADO_FACTURA_URL', 'http://factura.grupoado.com.mx')
+VALIDATE_PATH = '/jsp/validate.jsp'
+REGISTER_PATH = '/register.jsp'
+FACTURAR_PATH = '/facturar.jsp'
+
+# Max PDFs downloaded at the same time
+TICKET_WORKERS = int(os.getenv('ADO_TICKET_WORKERS', '4'))
+# Max lots invoiced at the same time
+LOT_WORKERS = int(os.getenv('ADO_LOT_WORKERS', '4'))
+
+# Months!
+MONTHS = {
+    'ENE': 1,
+    'FEB': 2,
+    'MAR': 3,
+    'ABR': 4,
+    'MAY': 5,
+    'JUN': 6,
+    'JUL': 7,
+    'AGO': 8,
+    'SEP': 9,
+    'OCT': 10,
+    'NOV': 11,
+    'DIC': 12
+}
+# Ticket dates look like '05 ENE 21'
+TICKET_DATE_PATTERN = re.compile(r'(\d{1,2}) (' + '|'.join(MONTHS) + r') (\d{2})')
+
+# Known passengers, comma separated, each one is invoiced on its own lot
+PASSENGERS = [name.strip() for name in os.getenv('ADO_PASSENGERS', 'RAFAEL YOBAIN LUNA GOMEZ').split(',') if name.strip()]
+# Max edit distance for a ticket name to count as a known passenger
+MAX_NAME_DISTANCE = 5
+
+# Every ticket field in a single pattern, one alternative per field, scanned once per page.
+# Each match says its field in lastgroup, the first match of a field is kept.
+# Fields are on lines of their own, so a match never swallows another field.
+# The folio is the number the page starts with
+TICKET_FIELDS = ['folio', 'name', 'seat', 'price', 'date']
+TICKET_PATTERN = re.compile(
+    r'\A(?P<folio>\d+)'
+    r'|/NAME(?P<name>.+)ORIGEN'
+    r'|SEAT(?P<seat>.+)FECHA'
+    r'|\$ (?P<price>.+)PRECIO'
+    r'|/DATEADULTO[^\d]+(?P<date>.+)HORA/HOUR'
+)
+
+
+def extract_tickets(pages):
+    '''
+    Extracts the ticket info of every page of an ADO PDF.
+    Returns {'tickets': [...], 'failures': [{'page': n, 'missing': [fields]}]},
+    pages with missing fields are reported in failures instead of tickets
+    '''
+    tickets = []
+    failures = []
+    for page_number, text in enumerate(pages):
+        ticket = dict.fromkeys(TICKET_FIELDS)
+        for match in TICKET_PATTERN.finditer(text):
+            if ticket[match.lastgroup] is None:
+                ticket[match.lastgroup] = match.group(match.lastgroup)
+        missing = [field for field in TICKET_FIELDS if ticket[field] is None]
+        if missing:
+            failures.append({'page': page_number, 'missing': missing})
+        else:
+            tickets.append(ticket)
+    return {'tickets': tickets, 'failures': failures}
+
+
+class UnreadPagesError(Exception):
+    '''
+    Raised when some pages of a ticket PDF are missing fields,
+    failures are the ones reported by extract_tickets
+    '''
+
+    def __init__(self, link, failures):
+        self.link = link
+        self.failures = failures
+        super().__init__('; '.join(
+            f'could not read {", ".join(failure["missing"])} from page {failure["page"]}' for failure in failures
+        ))
+
 
 def get_info_from_pdf_link(link, email_id):
     '''
-    Reads contents of PDF given a link
+    Reads contents of PDF given a link, going through the PDF cache.
+    Raises UnreadPagesError if any page is missing fields, so none of its tickets get lost
     '''
     print('Extracting info from pdf...')
-    pdf = requests.get(link).content
-    pdf_file = io.BytesIO(pdf)
-    reader = PyPDF2.PdfFileReader(pdf_file)
-    num_pages = reader.getNumPages()
-
-    ticket_info = []
-    for page_number in range(num_pages):
-        text = reader.getPage(page_number).extractText()
-        ticket_info.append({
-            'folio': re.search(r'^\d+', text).group(0),
-            'name': re.search(r'/NAME(.+)ORIGEN', text).group(1),
-            'seat': re.search(r'SEAT(.+)FECHA', text).group(1),
-            'price': re.search(r'\$ (.+)PRECIO', text).group(1),
-            'date': re.search(r'/DATEADULTO[^\d]+(.+)HORA/HOUR', text).group(1),
-            'email_id': email_id
-        })
+    with metrics.span('ado_pdf'):
+        extracted = pdf_cache.extract(link, 'ado_ticket_pages', extract_tickets)
+    if extracted['failures']:
+        raise UnreadPagesError(link, extracted['failures'])
+
+    ticket_info = extracted['tickets']
+    for ticket in ticket_info:
+        ticket['email_id'] = email_id
 
     for ticket in ticket_info:
         for k, i in ticket.items():
@@ -46,25 +122,162 @@ def get_info_from_pdf_link(link, email_id):
     return ticket_info
 
 
-def facturar_lote(tickets):
+def read_tickets(links, workers=TICKET_WORKERS):
     '''
-    Factura boletos de ADO en lote o individuales
+    Reads several PDFs concurrently, given (link, email_id) tuples.
+    Returns (email_id, tickets, error) per link, in the same order. Tickets are empty for
+    PDFs that can't be read (cancelled or changed tickets), and None along with the error
+    when reading failed otherwise, so it can be tried again
     '''
+    from PyPDF2.utils import PdfReadError
 
-    print("Facturando lote...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(get_info_from_pdf_link, link, email_id) for link, email_id in links]
+
+    results = []
+    for (link, email_id), future in zip(links, futures):
+        try:
+            results.append((email_id, future.result(), None))
+        except PdfReadError:
+            print("Unable to read ticket. Ticket is probably cancelled or changed")
+            results.append((email_id, [], None))
+        except Exception as error:
+            print(f"Error reading {link}: {error}")
+            results.append((email_id, None, error))
+    return results
+
+
+def parse_month(month):
+    '''
+    Parses a 'YYYY-MM' string into a (year, month) tuple
+    '''
+    year, month = month.split('-')
+    return int(year), int(month)
+
+
+def billing_window(now, first_month=None, last_month=None):
+    '''
+    Returns the (start, end) dates of the billing period, end not included.
+    first_month and last_month are 'YYYY-MM' strings, when not given
+    the period is the month before now. last_month defaults to first_month
+    '''
+    if first_month:
+        first_year, first = parse_month(first_month)
+    elif now.month > 1:
+        first_year, first = now.year, now.month - 1
+    else:
+        first_year, first = now.year - 1, 12
+    # A single month unless told otherwise
+    last_year, last = parse_month(last_month) if last_month else (first_year, first)
+
+    start = datetime.date(first_year, first, 1)
+    end = datetime.date(last_year + last // 12, last % 12 + 1, 1)
+    return start, end
+
+
+def parse_ticket_dates(tickets):
+    '''
+    Parses the date of every ticket in one pass, as day ordinals.
+    Dates that can't be parsed are None
+    '''
+    ordinals = []
+    for ticket in tickets:
+        match = TICKET_DATE_PATTERN.fullmatch(ticket['date'].strip())
+        if match is None:
+            print(f"Unable to read date '{ticket['date']}' of folio {ticket['folio']}")
+            ordinals.append(None)
+            continue
+        day, month, year = match.groups()
+        ordinals.append(datetime.date(2000 + int(year), MONTHS[month], int(day)).toordinal())
+    return ordinals
+
+
+def ticket_months(tickets):
+    '''
+    Returns the month of every ticket as a 'YYYY-MM' string, None when its date can't be read
+    '''
+    return [
+        None if ordinal is None else datetime.date.fromordinal(ordinal).strftime('%Y-%m')
+        for ordinal in parse_ticket_dates(tickets)
+    ]
+
+
+def bounded_distance(first, second, limit):
+    '''
+    Levenshtein distance between two strings, only computed within limit.
+    Returns limit + 1 as soon as the distance is known to be bigger than limit
+    '''
+    over = limit + 1
+    if abs(len(first) - len(second)) > limit:
+        return over
+
+    # Only cells within limit of the diagonal can be <= limit, the rest count as over
+    previous = [j if j <= limit else over for j in range(len(second) + 1)]
+    for i in range(1, len(first) + 1):
+        current = [over] * (len(second) + 1)
+        current[0] = i if i <= limit else over
+        low = max(1, i - limit)
+        high = min(len(second), i + limit)
+        for j in range(low, high + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (first[i - 1] != second[j - 1]),
+                over
+            )
+        # Every path from here on is already too long
+        if min(current[low - 1:high + 1]) > limit:
+            return over
+        previous = current
+    return previous[-1]
+
+
+def group_by_passenger(tickets, passengers=PASSENGERS, max_distance=MAX_NAME_DISTANCE):
+    '''
+    Assigns each ticket to the closest known passenger within max_distance.
+    Returns a list with the tickets of each known passenger, in the order of passengers,
+    followed by the tickets of everyone else. Empty groups are left out
+    '''
+    groups = {passenger: [] for passenger in passengers}
+    others = []
+    # Same name shows up in many tickets, only match it once
+    matches = {}
+    for ticket in tickets:
+        name = ticket['name']
+        if name not in matches:
+            distances = [(bounded_distance(name, passenger, max_distance), passenger) for passenger in passengers]
+            distance, passenger = min(distances, default=(max_distance + 1, None))
+            matches[name] = passenger if distance <= max_distance else None
+        if matches[name] is None:
+            others.append(ticket)
+        else:
+            groups[matches[name]].append(ticket)
+
+    return [group for group in list(groups.values()) + [others] if len(group) > 0]
+
+
+def register_lote(session, tickets, timings, base_url=FACTURA_URL):
+    '''
+    Validates the tickets of a lot and registers them, on the given session.
+    Returns the form data to invoice them with
+    '''
+    from bs4 import BeautifulSoup
 
-    # Start an http session
-    session = requests.Session()
     # Validate all tickets together and obtain idlote
+    # Each validation needs the IDL of the previous one, so they go in order
     id_lote = -1
+    timings['validate'] = []
     for ticket in tickets:
-        response = session.post(VALIDATE_URL, data={
+        start = time.monotonic()
+        response = session.post(base_url + VALIDATE_PATH, data={
             'tipo': 'validateFolio',
             'folio': ticket['folio'],
             'asiento': ticket['seat'],
             'rfc': RFC,
             'idl': id_lote
         })
+        timings['validate'].append(time.monotonic() - start)
+        metrics.observe('ado_step', timings['validate'][-1], step='validate')
         id_lote = response.json()[0]['IDL']
 
     # Registrar factura
@@ -75,7 +288,10 @@ def facturar_lote(tickets):
     }
     register_data['sch_Id_Ticket'] = tickets[0]['folio'] if len(tickets) == 1 else ''
     register_data['sch_Ticket_Amount'] = tickets[0]['seat'] if len(tickets) == 1 else ''
-    response = session.post(REGISTER_URL, data=register_data)
+    start = time.monotonic()
+    response = session.post(base_url + REGISTER_PATH, data=register_data)
+    timings['register'] = time.monotonic() - start
+    metrics.observe('ado_step', timings['register'], step='register')
 
     # Scrape pre-existing data
     # Gather data from IDs
@@ -108,10 +324,39 @@ def facturar_lote(tickets):
     del data['IDDatosCliente']
 
     pp(data)
+    return data
+
+
+def facturar_lote(tickets, timings=None, base_url=FACTURA_URL):
+    '''
+    Factura boletos de ADO en lote o individuales, on the invoicing site at base_url.
+    Folios are FAILED if anything breaks before the invoice is requested, since
+    nothing was invoiced yet and they can be tried again.
+    If a timings dict is given, seconds spent on each step are stored in it
+    '''
+    from bs4 import BeautifulSoup
+
+    if timings is None:
+        timings = {}
+
+    print("Facturando lote...")
+
+    # Start an http session
+    session = http_client.HTTPClient()
+    try:
+        data = register_lote(session, tickets, timings, base_url)
+    except Exception:
+        ledger.LEDGER.mark_folios(tickets, ledger.FAILED)
+        raise
 
     # CRITICAL PART!
     # Facturar
-    response = session.post(FACTURAR_URL, data=data)
+    # Record the attempt first, so a crash here is never invoiced twice
+    ledger.LEDGER.mark_folios(tickets, ledger.INVOICING)
+    start = time.monotonic()
+    response = session.post(base_url + FACTURAR_PATH, data=data)
+    timings['facturar'] = time.monotonic() - start
+    metrics.observe('ado_step', timings['facturar'], step='facturar')
 
     if response.ok:
         print('Facturación exitosa')
@@ -119,7 +364,38 @@ def facturar_lote(tickets):
         soup = BeautifulSoup(response.text, 'html.parser')
         pdf_js = soup.find(id='buttondwPDF').get('onclick')
         pdf_link = re.search(r'\(\'(.+)\'\)', pdf_js).group(1)
+        ledger.LEDGER.mark_folios(tickets, ledger.INVOICED, pdf_link)
         return pdf_link
 
     print('Facturación fallida :-(')
+    ledger.LEDGER.mark_folios(tickets, ledger.FAILED)
     return None
+
+
+def facturar_lotes(lots, workers=LOT_WORKERS, base_url=FACTURA_URL):
+    '''
+    Factura varios lotes al mismo tiempo, each one with its own session.
+    Tickets within a lot keep their order.
+    Returns a (pdf_link, timings) tuple per lot, in the same order as the lots
+    '''
+    def facturar(tickets):
+        timings = {}
+        try:
+            pdf_link = facturar_lote(tickets, timings, base_url)
+        except Exception as error:
+            print(f'Error facturando lote: {error}')
+            pdf_link = None
+        return pdf_link, timings
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(facturar, lots))
+
+    for tickets, (_, timings) in zip(lots, results):
+        folios = ', '.join(ticket['folio'] for ticket in tickets)
+        validate = timings.get('validate', [])
+        print(f'Lote {folios}: '
+              f'validate {sum(validate):.2f}s ({len(validate)} calls, max {max(validate, default=0):.2f}s), '
+              f'register {timings.get("register", 0):.2f}s, '
+              f'facturar {timings.get("facturar", 0):.2f}s')
+
+    return results
@@ -2,18 +2,296 @@
 Module for processing D&C emails and transactions
 '''
 
+import os
 import re
-import io
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+from html import unescape
+from urllib.parse import urlencode, quote
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+import pdf_cache
+
+
+# Worker pool used by process_emails
+# Threads handle emails that wait on downloads (ADO PDFs),
+# processes are optional and handle CPU bound HTML parsing
+PARSE_WORKERS = int(os.getenv('DC_PARSE_WORKERS', '4'))
+PARSE_PROCESSES = int(os.getenv('DC_PARSE_PROCESSES', '0'))
+# Process pools by size, started on first use and kept for later calls,
+# so a page of emails doesn't pay for starting processes
+PROCESS_POOLS = {}
+PROCESS_POOLS_LOCK = threading.Lock()
+
+# BeautifulSoup backend, 'lxml' is faster when it's installed
+HTML_PARSER = os.getenv('DC_HTML_PARSER', 'html.parser')
+
+# What a parser receives: the email html as a soup, the raw html,
+# or the text of each page of the PDF linked in the email
+SOUP = "soup"
+HTML = "html"
+ATTACHMENT = "attachment"
+
+# Registered parsers by sender name, each one a list of
+# (subject predicate, parser, input, tags to keep in soup) checked in registration order
+PARSERS = {}
+
+# Ids of emails no parser matched, so they are not looked at again
+UNMATCHED_EMAIL_IDS = set()
+
+# Emails whose parser failed this many times in a row are quarantined,
+# their ids are kept in QUARANTINED_EMAIL_IDS and they are not looked at again
+QUARANTINE_AFTER = int(os.getenv('DC_QUARANTINE_AFTER', '3'))
+QUARANTINED_EMAIL_IDS = set()
+FAILURE_COUNTS = {}
+# Errors that mean a parser can't read an email. Anything else (network errors
+# downloading a PDF, full disk...) says nothing about the email, and neither does
+# an OSError, which is what requests' exceptions are
+PARSER_ERRORS = (AttributeError, IndexError, KeyError, TypeError, ValueError)
+
+# Html of failing emails is saved here, at most FAILURE_SAMPLES per parser,
+# so broken parsers can be replayed offline
+FAILURE_DIR = os.getenv('DC_FAILURE_DIR', '.parser_failures')
+FAILURE_SAMPLES = int(os.getenv('DC_FAILURE_SAMPLES', '20'))
+
+# Calls, failures and time per parser name, with the last PROFILE_SAMPLES durations for percentiles
+PROFILE_SAMPLES = 1000
+PROFILE = {}
+PROFILE_LOCK = threading.Lock()
+
+# Precompiled patterns used by the parsers
+BOLETO_PATTERN = re.compile("Boleto")
+UBER_AMOUNT_PATTERN = re.compile(r"MX\$.+")
+PARKIMOVIL_PLACE_PATTERN = re.compile(r"<strong>(.+)</strong>\s*le agradece su visita\.")
+
+
+# URL Schemes
+EXPENSE_URL_SCHEME = "dcapp://x-callback-url/expense?"
+TRANSFER_URL_SCHEME = "dcapp://x-callback-url/transfer?"
+
+
+class NoRuleError(Exception):
+    '''
+    Raised when no parser is registered for an email's sender and subject
+    '''
+
+
+class Transaction:
+    '''
+    Transaction found in an email, with a fixed set of fields.
+    Fields left as None are not part of it
+    '''
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self, **values):
+        unknown = set(values) - set(self.FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown {type(self).__name__} fields: {', '.join(sorted(unknown))}")
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    def items(self):
+        '''
+        Returns the (field, value) pairs that are set, in field order
+        '''
+        return [(field, getattr(self, field)) for field in self.FIELDS if getattr(self, field) is not None]
+
+    @staticmethod
+    def from_dict(transaction):
+        '''
+        Builds a transfer or an expense from a parser's dict,
+        transfers are told apart by their source account
+        '''
+        if "source_account" in transaction:
+            return Transfer(**transaction)
+        return Expense(**transaction)
+
+
+class Expense(Transaction):
+    '''
+    Expense, charged to the credit card unless another account is given
+    '''
+
+    __slots__ = FIELDS = ("amount", "description", "category", "payee", "tag", "notes", "account")
+
+    def __init__(self, **values):
+        values.setdefault("account", "BBVA Crédito")
+        super().__init__(**values)
+
+
+class Transfer(Transaction):
+    '''
+    Transfer between two accounts
+    '''
+
+    __slots__ = FIELDS = ("amount", "description", "source_account", "destination_account")
+
+
+class MessageTemplate:
+    '''
+    Telegram message and D&C url scheme of a transaction type.
+    Everything that doesn't depend on the values is built once
+    '''
+
+    def __init__(self, title, url_scheme, fields):
+        self.header = f"<b>{title}</b>\n\n"
+        self.url_scheme = url_scheme
+        self.labels = {field: f"<b>{field.title()}</b>: " for field in fields}
+
+    def render(self, transaction, date_string):
+        '''
+        Returns the url scheme and the message text of a transaction
+        '''
+        items = transaction.items()
+        url = self.url_scheme + urlencode(items, quote_via=quote)
+        lines = [self.header]
+        lines.extend(f"{self.labels[field]}{value}\n" for field, value in items)
+        lines.append(f"\n<b>Date</b>: {date_string}\n\n<b>D&C URL scheme</b>: {url}")
+        return url, "".join(lines)
+
+
+TEMPLATES = {
+    Expense: MessageTemplate("Gasto detectado", EXPENSE_URL_SCHEME, Expense.FIELDS),
+    Transfer: MessageTemplate("Transferencia detectada", TRANSFER_URL_SCHEME, Transfer.FIELDS)
+}
+
+
+def render_transaction(transaction, date_string):
+    '''
+    Returns the url scheme and the telegram message text of a transaction
+    '''
+    return TEMPLATES[type(transaction)].render(transaction, date_string)
+
+
+def register(sender, subject=None, needs=SOUP, only=None):
+    '''
+    Registers the decorated function as the parser for emails of the given sender.
+    subject can be None to match any subject, a string to match it exactly,
+    or a function that receives the subject and returns whether it matches.
+    only can list the tag names a SOUP parser looks into, so the rest of the html
+    is not built into the tree
+    '''
+    if subject is None:
+        predicate = lambda _: True
+    elif isinstance(subject, str):
+        predicate = subject.__eq__
+    else:
+        predicate = subject
+
+    def decorator(parser):
+        PARSERS.setdefault(sender, []).append((predicate, parser, needs, only))
+        return parser
+
+    return decorator
+
+
+def find_parser(email):
+    '''
+    Looks up the parser for an email by sender, then by subject.
+    Returns a (parser, input, tags to keep) tuple, or None if no rule matches
+    '''
+    sender = email["sender"]["emailAddress"]["name"]
+    for predicate, parser, needs, only in PARSERS.get(sender, ()):
+        if predicate(email["subject"]):
+            return parser, needs, only
+    return None
+
+
+def make_soup(html, only=None):
+    '''
+    Builds a soup of the html, only keeping the given tag names (and everything
+    inside them) when only is set
+    '''
+    # bs4 is only imported once a parser needs a soup
+    from bs4 import BeautifulSoup, SoupStrainer
+
+    parse_only = SoupStrainer(only) if only else None
+    return BeautifulSoup(html, HTML_PARSER, parse_only=parse_only)
+
+
+class TextFinder(HTMLParser):
+    '''
+    Streams through html looking for the first text that matches a pattern,
+    without building any tree
+    '''
+
+    class Found(Exception):
+        '''
+        Raised to stop parsing once the text was found
+        '''
+
+    def __init__(self, pattern):
+        super().__init__()
+        self.pattern = pattern
+        self.text = None
 
-import requests
-import PyPDF2
-from bs4 import BeautifulSoup
+    def handle_data(self, data):
+        if self.pattern.search(data):
+            self.text = data
+            raise self.Found()
 
-def process_uber_eats(soup):
+
+def first_text(html, pattern):
+    '''
+    Returns the first text in the html that matches the compiled pattern, or None
+    '''
+    finder = TextFinder(pattern)
+    try:
+        finder.feed(html)
+        finder.close()
+    except TextFinder.Found:
+        pass
+    return finder.text
+
+
+def match_email(email):
+    '''
+    Finds the rule for an email like find_parser, recording emails without one
+    in UNMATCHED_EMAIL_IDS so they are skipped right away on later calls.
+    Quarantined emails have no rule either
+    '''
+    if email["id"] in UNMATCHED_EMAIL_IDS or email["id"] in QUARANTINED_EMAIL_IDS:
+        return None
+    rule = find_parser(email)
+    if rule is None:
+        print(f"No rule for email '{email['subject']}', skipping from now on...")
+        UNMATCHED_EMAIL_IDS.add(email["id"])
+    return rule
+
+
+def find_boleto_link(html):
+    '''
+    Gets the link to the ticket PDF from an ADO email's html, or None if it has none
+    '''
+    soup = make_soup(html, "a")
+    anchor = soup.find("a", string=BOLETO_PATTERN)
+    return anchor["href"] if anchor is not None else None
+
+
+def get_attachment(email):
     '''
-    Process the soup of an uber eats email, searching for transaction data
+    Gets the text of each page of the PDF linked in an email, from the PDF cache
     '''
-    amount = soup.find(text=re.compile(r"MX\$.+")).strip().replace("MX$", "")
+    link = find_boleto_link(email["body"]["content"])
+    if link is None:
+        raise ValueError(f"No ticket link in '{email['subject']}'")
+    return pdf_cache.get_pages(link)
+
+
+@register("Uber Receipts", subject=lambda subject: "Uber Eats" in subject, needs=HTML)
+def process_uber_eats(html):
+    '''
+    Process the html of an uber eats email, searching for transaction data
+    '''
+    amount = first_text(html, UBER_AMOUNT_PATTERN).strip().replace("MX$", "")
     description = "Comida"
 
     return {
@@ -23,11 +301,12 @@ def process_uber_eats(soup):
         "payee": "Uber Eats"
     }
 
-def process_uber(soup):
+@register("Uber Receipts", needs=HTML)
+def process_uber(html):
     '''
-    Process the soup of an uber email, searching for transaction data
+    Process the html of an uber email, searching for transaction data
     '''
-    amount = soup.find(text=re.compile(r"MX\$.+")).strip().replace("MX$", "")
+    amount = first_text(html, UBER_AMOUNT_PATTERN).strip().replace("MX$", "")
     return {
         "amount": amount,
         "description": "Uber",
@@ -35,20 +314,13 @@ def process_uber(soup):
         "payee": "Uber"
     }
 
-def process_ado(soup):
+@register("ADO en Linea", needs=ATTACHMENT)
+def process_ado(pages):
     '''
-    Processes the soup of an ADO email, searching for transaction data within it"s PDF
+    Processes the PDF pages of an ADO email, searching for transaction data
     '''
-    # Get link to pdf
-    link = soup.find("a", string=re.compile("Boleto"))["href"]
-    pdf = requests.get(link).content
-    pdf_file = io.BytesIO(pdf)
-    reader = PyPDF2.PdfFileReader(pdf_file)
-    num_pages = reader.getNumPages()
-
     amount = 0
-    for page_number in range(num_pages):
-        text = reader.getPage(page_number).extractText()
+    for text in pages:
         amount += float(re.search(r"\$ (.+)PRECIO TOTAL", text).group(1))
 
     return {
@@ -60,10 +332,13 @@ def process_ado(soup):
     }
 
 
-def process_parkimovil(soup):
+@register("Parkimovil", needs=HTML)
+def process_parkimovil(html):
     '''
-    Processes soup for Parkimovil email
+    Processes html for Parkimovil email
     '''
+    # The total is in the receipt's table, the rest of the html is left out of the soup
+    soup = make_soup(html, ["tr"])
 
     # Get ammount
     # Get <strong> tag with string "Total:"
@@ -74,7 +349,8 @@ def process_parkimovil(soup):
     amount = total_price_string.replace("MX$", "")
 
     # Get parking location by finding tag with "le agradece su visita."
-    visit_place = re.search(r"<strong>(.+)</strong>\s*le agradece su visita\.", str(soup)).group(1)
+    # Search the unescaped html instead of serializing the whole soup back to a string
+    visit_place = PARKIMOVIL_PLACE_PATTERN.search(unescape(html)).group(1)
 
     return {
         "amount": amount,
@@ -84,6 +360,7 @@ def process_parkimovil(soup):
         "notes": f"Lugar: {visit_place}"
     }
 
+@register("Apple", subject="Your receipt from Apple.", only=["tr"])
 def process_apple_recepit(soup):
     '''
     Processes soup for Apple receipt email
@@ -106,6 +383,7 @@ def process_apple_recepit(soup):
         "payee": "Apple"
     }
 
+@register("Cineticket Web", subject="Confirmación de Orden", only=["tr"])
 def process_cinepolis_ticket(soup):
     '''
     Processes soup for Cinépolis ticket email
@@ -132,6 +410,7 @@ def process_cinepolis_ticket(soup):
         "notes": theater
     }
 
+@register("Clientes BBVA", subject="Retiro sin tarjeta", only=["p"])
 def process_bbva_retiro(soup):
     '''
     Processes soup for retiro from BBVA email
@@ -151,38 +430,208 @@ def process_bbva_retiro(soup):
 def process_email(email):
     '''
     Generic process email for transaction.
-    Depending on sender and subject, sends email"s html in soup form to corresponding method
+    Depending on sender and subject, sends email"s html, soup or attachment
+    to the corresponding registered parser
     '''
-    soup = BeautifulSoup(email["body"]["content"], "html.parser")
     sender = email["sender"]["emailAddress"]["name"]
     subject = email["subject"]
 
+    rule = find_parser(email)
+    if rule is None:
+        print(f"No rule for sender '{sender}' with subject '{subject}', skipping...")
+        raise NoRuleError(f"No rule for sender '{sender}' with subject '{subject}'")
+    parser, needs, only = rule
+
     print(f"Processing {subject}")
 
-    # Handle Uber and Uber Eats
-    if sender == "Uber Receipts":
-        if "Uber Eats" in subject:
-            log_data = process_uber_eats(soup)
-        else:
-            log_data = process_uber(soup)
+    # Only build what the parser asks for
+    if needs == SOUP:
+        data = make_soup(email["body"]["content"], only)
+    elif needs == HTML:
+        data = email["body"]["content"]
+    else:
+        data = get_attachment(email)
 
-    elif sender == "ADO en Linea":
-        log_data = process_ado(soup)
+    return parser(data)
 
-    elif sender == "Parkimovil":
-        log_data = process_parkimovil(soup)
 
-    elif sender == "Apple" and subject == "Your receipt from Apple.":
-        log_data = process_apple_recepit(soup)
+def parse_email(email):
+    '''
+    Runs process_email, timing it. Returns (result, error, seconds).
+    It may run in a worker process, so what it measures is returned
+    to be recorded with record_parse by the caller
+    '''
+    start = time.perf_counter()
+    try:
+        result = process_email(email)
+    except Exception as error:
+        return None, error, time.perf_counter() - start
+    return result, None, time.perf_counter() - start
 
-    elif sender == "Cineticket Web" and subject == "Confirmación de Orden":
-        log_data = process_cinepolis_ticket(soup)
 
-    elif sender == "Clientes BBVA" and subject == "Retiro sin tarjeta":
-        log_data = process_bbva_retiro(soup)
+def record_parse(email, error, seconds):
+    '''
+    Records a parse of an email in its parser's profile.
+    Emails the parser fails on (see is_parser_error) get a sample saved,
+    and are quarantined after QUARANTINE_AFTER failures in a row
+    '''
+    rule = find_parser(email)
+    name = rule[0].__name__ if rule is not None else "none"
+    with PROFILE_LOCK:
+        profile = PROFILE.setdefault(name, {
+            "calls": 0,
+            "failures": 0,
+            "seconds": 0.0,
+            "durations": deque(maxlen=PROFILE_SAMPLES)
+        })
+        profile["calls"] += 1
+        profile["failures"] += int(error is not None and is_parser_error(error))
+        profile["seconds"] += seconds
+        profile["durations"].append(seconds)
+    metrics.observe("parser", seconds, parser=name)
+
+    if error is None:
+        FAILURE_COUNTS.pop(email["id"], None)
+        return
+    if not is_parser_error(error):
+        print(f"Could not parse '{email['subject']}' with {name}, will try again: {error!r}")
+        return
+
+    metrics.inc("parser_failures", parser=name)
+    print(f"Parser {name} failed on '{email['subject']}': {error!r}")
+    save_failure_sample(email, name, error)
+    FAILURE_COUNTS[email["id"]] = FAILURE_COUNTS.get(email["id"], 0) + 1
+    if FAILURE_COUNTS[email["id"]] >= QUARANTINE_AFTER:
+        print(f"Quarantining '{email['subject']}' after {QUARANTINE_AFTER} failures")
+        QUARANTINED_EMAIL_IDS.add(email["id"])
+        del FAILURE_COUNTS[email["id"]]
+
+
+def is_parser_error(error):
+    '''
+    Returns whether an error raised while parsing an email comes from the parser
+    not understanding it, rather than from something it depends on
+    '''
+    return isinstance(error, PARSER_ERRORS) and not isinstance(error, OSError)
 
-    else:
-        print(f"No rule for sender '{sender}' with subject '{subject}', skipping...")
-        raise Exception(f"No rule for sender '{sender}' with subject '{subject}'")
 
-    return log_data
+def save_failure_sample(email, name, error):
+    '''
+    Saves the html of an email its parser failed on, with what went wrong,
+    unless the parser already has FAILURE_SAMPLES of them
+    '''
+    directory = os.path.join(FAILURE_DIR, name)
+    os.makedirs(directory, exist_ok=True)
+    # Each sample is an html and a json file
+    if len(os.listdir(directory)) >= 2 * FAILURE_SAMPLES:
+        return
+    sample = hashlib.sha1(email["id"].encode()).hexdigest()[:16]
+    with open(os.path.join(directory, f"{sample}.html"), "w") as html_file:
+        html_file.write(email["body"]["content"])
+    with open(os.path.join(directory, f"{sample}.json"), "w") as meta_file:
+        json.dump({
+            "id": email["id"],
+            "subject": email["subject"],
+            "sender": email["sender"]["emailAddress"]["name"],
+            "error": repr(error)
+        }, meta_file)
+
+
+def parser_stats():
+    '''
+    Returns the calls, failure rate, total and p99 seconds of every parser
+    '''
+    with PROFILE_LOCK:
+        profiles = {name: dict(profile, durations=sorted(profile["durations"])) for name, profile in PROFILE.items()}
+    return {
+        name: {
+            "calls": profile["calls"],
+            "failure_rate": profile["failures"] / profile["calls"],
+            "seconds": profile["seconds"],
+            "p99_seconds": profile["durations"][min(len(profile["durations"]) - 1, int(0.99 * len(profile["durations"])))]
+        }
+        for name, profile in profiles.items()
+    }
+
+
+def print_parser_stats():
+    '''
+    Prints the profile of every parser
+    '''
+    print("Parser profile:")
+    for name, stats in sorted(parser_stats().items()):
+        print(f"\t{name}: {stats['calls']} calls, {stats['failure_rate']:.1%} failed, "
+              f"{stats['seconds']:.3f}s total, p99 {stats['p99_seconds'] * 1000:.2f}ms")
+
+
+def get_process_pool(processes):
+    '''
+    Returns the shared pool with that many processes, None if processes is 0
+    '''
+    if processes <= 0:
+        return None
+    with PROCESS_POOLS_LOCK:
+        if processes not in PROCESS_POOLS:
+            PROCESS_POOLS[processes] = ProcessPoolExecutor(max_workers=processes)
+        return PROCESS_POOLS[processes]
+
+
+def discard_process_pool(pool):
+    '''
+    Drops a broken pool (one of its processes died), the next call to
+    get_process_pool starts a new one
+    '''
+    with PROCESS_POOLS_LOCK:
+        for processes, shared_pool in list(PROCESS_POOLS.items()):
+            if shared_pool is pool:
+                del PROCESS_POOLS[processes]
+    pool.shutdown(wait=False)
+
+
+def process_emails(emails, workers=PARSE_WORKERS, processes=PARSE_PROCESSES):
+    '''
+    Processes several emails concurrently.
+    Emails whose parser needs an attachment run on a thread pool, the rest run on
+    the shared process pool when processes > 0, or on the same thread pool otherwise.
+    Emails without a rule are recorded in UNMATCHED_EMAIL_IDS and skipped on later calls.
+    Every parse is recorded with record_parse.
+    Returns a (result, error) tuple per email, in the same order as the emails
+    '''
+    if not emails:
+        return []
+
+    process_pool = get_process_pool(processes)
+    with ThreadPoolExecutor(max_workers=workers) as thread_pool:
+        # Look up rules before submitting anything, unmatched emails never reach a pool
+        futures = []
+        for email in emails:
+            rule = match_email(email)
+            if rule is None:
+                futures.append((None, None))
+            elif process_pool is None or rule[1] == ATTACHMENT:
+                futures.append((thread_pool, thread_pool.submit(parse_email, email)))
+            else:
+                try:
+                    futures.append((process_pool, process_pool.submit(parse_email, email)))
+                except BrokenProcessPool:
+                    # Broke since the last call, a new one takes over
+                    discard_process_pool(process_pool)
+                    process_pool = get_process_pool(processes)
+                    futures.append((process_pool, process_pool.submit(parse_email, email)))
+
+        # Collect in submission order, keeping errors per email
+        results = []
+        for email, (pool, future) in zip(emails, futures):
+            if future is None:
+                results.append((None, NoRuleError(f"No rule for email '{email['subject']}'")))
+                continue
+            try:
+                result, error, seconds = future.result()
+            except BrokenProcessPool as error:
+                # Not the parser's fault, the email is tried again on a new pool
+                discard_process_pool(pool)
+                results.append((None, error))
+                continue
+            record_parse(email, error, seconds)
+            results.append((result, error))
+        return results
@@ -0,0 +1,433 @@
+'''
+Benchmark runner that replays a recorded fixture corpus through the real D&C and
+ADO jobs. Graph, Telegram and ADO's invoicing site are answered by local stand-ins,
+PDFs come from the corpus.
+Record a corpus by running the jobs once with HTTP_RECORD_DIR set, then:
+
+    python benchmark.py CORPUS_DIR --scale 1 100 10000
+
+The Graph stand-in lists every recorded email of a folder scale times under new ids.
+debit_and_credit_automation runs over the D&C folder, collect_ado and facturar_ado
+over the ADO folder (DEBIT_AND_CREDIT_FOLDER_ID and ADO_FOLDER_ID, or --dc-folder
+and --ado-folder). Reports throughput, p50/p99 latency per stage and peak memory.
+
+    python benchmark.py --html-parsers
+
+times instead every parser over the emails of the parser tests (tests/fixtures/emails),
+with each BeautifulSoup backend, on the soups, text and html the parsers read now and
+on full soups, and
+
+    python benchmark.py --pools --emails 300
+
+times DC.process_emails over that many of them, cycled, run serially, on threads and on processes
+
+    python benchmark.py --render --repeat 10000
+
+times the telegram messages of a few sample transactions, built from DC's templates
+and by concatenation as they were before. These three need no corpus
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import functools
+import tempfile
+import resource
+import tracemalloc
+from urllib.parse import urlsplit, parse_qs
+
+
+FOLDER_PATTERN = re.compile(r'/mailFolders/([^/]+)/messages')
+# Emails of the parser tests, listed with their sender and subject in emails.json
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', 'emails')
+
+# Calls timed on every run: stage, module or object, attribute
+STAGES = (
+    ('page', 'main', 'process_page'),
+    ('parse_page', 'DC', 'process_emails'),
+    ('notify', 'telegram_sender', 'SENDER.deliver'),
+    ('delete', 'main', 'delete_emails_in_folder'),
+    ('collect', 'ADO', 'read_tickets'),
+    ('invoice', 'ADO', 'facturar_lote')
+)
+# Durations of the current run, by stage
+DURATIONS = {}
+
+# Pages served by the ADO invoicing stand-in
+REGISTER_PAGE = ''.join(
+    f'<input id="{field}" value="{field.lower()}">'
+    for field in ('RRfc', 'IDDatosCliente', 'RName', 'RCalle', 'RColonia', 'RNumExt', 'RNumInt',
+                  'RMunicipio', 'RCodigoPostal', 'RPais', 'REmail')
+) + '<script>\n$(\'#RNac [value="MEX"]\');\n$(\'#REstado [value="CDMX"]\');\n</script>'
+FACTURAR_PAGE = '<button id="buttondwPDF" onclick="descargar(\'http://localhost/factura.pdf\')">PDF</button>'
+
+# Transactions rendered with --render: an expense, an ADO ticket, one with notes and a transfer
+RENDER_TRANSACTIONS = (
+    {'amount': '123.40', 'description': 'Uber', 'category': 'Taxi', 'payee': 'Uber'},
+    {'amount': 1250.0, 'description': 'ADO', 'category': 'Deudas', 'payee': 'ADO', 'tag': 'Deudas'},
+    {'amount': '180.00', 'description': 'Dune Parte Dos ', 'category': 'Entretenimiento',
+     'payee': 'Cinépolis', 'notes': 'Cinépolis Plaza Carso'},
+    {'amount': '1,500.00', 'description': 'Retiro', 'source_account': 'BBVA Débito', 'destination_account': 'Efectivo'}
+)
+
+
+def load_emails(corpus):
+    '''
+    Returns the emails found in the recorded Graph message pages, by folder id, once each
+    '''
+    folders = {}
+    for meta, body in corpus.responses():
+        match = FOLDER_PATTERN.search(meta['url'])
+        if meta['method'] != 'GET' or meta['status'] != 200 or match is None:
+            continue
+        emails = folders.setdefault(match.group(1), {})
+        for email in json.loads(body).get('value', ()):
+            if 'body' in email and 'sender' in email:
+                emails[email['id']] = email
+    return {folder_id: list(emails.values()) for folder_id, emails in folders.items()}
+
+
+def load_fixture_emails():
+    '''
+    Returns the emails of the parser tests as Graph messages
+    '''
+    with open(os.path.join(FIXTURE_DIR, 'emails.json'), encoding='utf-8') as manifest:
+        cases = json.load(manifest)
+    emails = []
+    for case in cases:
+        with open(os.path.join(FIXTURE_DIR, case['file']), encoding='utf-8') as fixture:
+            emails.append({
+                'id': case['file'],
+                'subject': case['subject'],
+                'sender': {'emailAddress': {'name': case['sender']}},
+                'body': {'content': fixture.read()}
+            })
+    return emails
+
+
+class GraphStandIn:
+    '''
+    Stand-in for Graph. Lists every email of a folder scale times, each copy with
+    its own id, a page at a time, and accepts every $batch delete
+    '''
+
+    def __init__(self, folders, scale, page_size):
+        self.folders = folders
+        self.scale = scale
+        self.page_size = page_size
+
+    def respond(self, method, url, kwargs):
+        parts = urlsplit(url)
+        if method == 'POST' and parts.path.endswith('/$batch'):
+            return 200, {'responses': [
+                {'id': request['id'], 'status': 204} for request in kwargs['json']['requests']
+            ]}
+
+        match = FOLDER_PATTERN.search(parts.path)
+        emails = self.folders.get(match.group(1), []) if match else []
+        skip = int(parse_qs(parts.query).get('$skip', ['0'])[0])
+        end = min(skip + self.page_size, len(emails) * self.scale)
+        page = {'value': [
+            dict(emails[index % len(emails)], id=f'{emails[index % len(emails)]["id"]}-{index // len(emails)}')
+            for index in range(skip, end)
+        ]}
+        if end < len(emails) * self.scale:
+            page['@odata.nextLink'] = f'{parts.scheme}://{parts.netloc}{parts.path}?$skip={end}'
+        return 200, page
+
+
+def ado_stand_in(method, url, kwargs):
+    '''
+    Stand-in for ADO's invoicing site, every ticket is valid and every invoice goes through
+    '''
+    path = urlsplit(url).path
+    if path.endswith('validate.jsp'):
+        return 200, [{'IDL': '1'}]
+    if path.endswith('register.jsp'):
+        return 200, REGISTER_PAGE
+    return 200, FACTURAR_PAGE
+
+
+def time_calls(stage, owner, name):
+    '''
+    Replaces owner.name with a wrapper that adds the duration of every call to DURATIONS
+    '''
+    function = getattr(owner, name)
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            DURATIONS.setdefault(stage, []).append(time.perf_counter() - start)
+
+    setattr(owner, name, timed)
+
+
+def percentile(durations, fraction):
+    '''
+    Returns the duration below which the given fraction of durations fall
+    '''
+    if not durations:
+        return 0.0
+    ordered = sorted(durations)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(folders, scale, dc_folder, ado_folder, scratch):
+    '''
+    Runs the D&C and ADO jobs once over the corpus listed scale times.
+    Returns the number of emails of each job and the seconds each one took
+    '''
+    import DC
+    import ADO
+    import main
+    import ledger
+    import fixtures
+
+    # Every run starts from an empty ledger and no parser history
+    ledger.LEDGER = ledger.Ledger(os.path.join(scratch, f'ledger-{scale}.sqlite3'))
+    for ids in (DC.UNMATCHED_EMAIL_IDS, DC.QUARANTINED_EMAIL_IDS, DC.FAILURE_COUNTS, DC.PROFILE):
+        ids.clear()
+    DURATIONS.clear()
+    fixtures.CORPUS.stub('graph.microsoft.com', GraphStandIn(folders, scale, main.MAIL_PAGE_SIZE).respond)
+
+    counts, seconds = {}, {}
+    if dc_folder in folders:
+        counts['debit_and_credit'] = len(folders[dc_folder]) * scale
+        start = time.monotonic()
+        main.debit_and_credit_automation(folder_id=dc_folder)
+        seconds['debit_and_credit'] = time.monotonic() - start
+    if ado_folder in folders:
+        counts['ado'] = len(folders[ado_folder]) * scale
+        start = time.monotonic()
+        main.collect_ado(folder_id=ado_folder)
+        # Invoice every collected month
+        first_month, last_month = ledger.LEDGER.execute('SELECT MIN(month), MAX(month) FROM tickets')[0]
+        if first_month is not None:
+            main.facturar_ado(first_month, last_month, folder_id=ado_folder)
+        seconds['ado'] = time.monotonic() - start
+
+    # Per email parse times come from the parsers' profile
+    DURATIONS['parse_email'] = [
+        duration for profile in DC.PROFILE.values() for duration in profile['durations']
+    ]
+    return counts, seconds
+
+
+def compare_html_parsers(emails, repeat):
+    '''
+    Times the parsing of the emails that don't need a PDF, repeat times, with each
+    BeautifulSoup backend available, restricted as the parsers ask and on full soups
+    '''
+    import DC
+    from bs4 import BeautifulSoup, FeatureNotFound
+
+    emails = [email for email in emails if (DC.find_parser(email) or (None, DC.ATTACHMENT))[1] != DC.ATTACHMENT]
+    print(f'\nParsing {len(emails)} emails {repeat} times')
+    make_soup = DC.make_soup
+    html_parser = DC.HTML_PARSER
+    for backend in ('html.parser', 'lxml'):
+        try:
+            BeautifulSoup('', backend)
+        except FeatureNotFound:
+            print(f'\t{backend}: not installed')
+            continue
+        DC.HTML_PARSER = backend
+        for mode, soup in (('restricted', make_soup), ('full', lambda html, only=None: BeautifulSoup(html, backend))):
+            DC.make_soup = soup
+            durations = []
+            for _ in range(repeat):
+                for email in emails:
+                    start = time.perf_counter()
+                    try:
+                        DC.process_email(email)
+                    except Exception:
+                        pass
+                    durations.append(time.perf_counter() - start)
+            print(f'\t{backend}, {mode}: {sum(durations):.2f}s, '
+                  f'p50 {percentile(durations, 0.5) * 1000:.2f}ms, '
+                  f'p99 {percentile(durations, 0.99) * 1000:.2f}ms')
+    DC.make_soup = make_soup
+    DC.HTML_PARSER = html_parser
+
+
+def compare_pools(emails, count, workers):
+    '''
+    Times DC.process_emails over count emails, cycling through the given ones
+    under new ids, run serially, on a thread pool and on a process pool
+    '''
+    import DC
+
+    if not emails:
+        return
+    emails = [
+        dict(emails[index % len(emails)], id=f'{emails[index % len(emails)]["id"]}-{index}')
+        for index in range(count)
+    ]
+    print(f'\nProcessing {count} emails with {workers} workers')
+    for mode, threads, processes in (('serial', 1, 0), ('threads', workers, 0), ('processes', workers, workers)):
+        for ids in (DC.UNMATCHED_EMAIL_IDS, DC.QUARANTINED_EMAIL_IDS, DC.FAILURE_COUNTS):
+            ids.clear()
+        start = time.perf_counter()
+        results = DC.process_emails(emails, workers=threads, processes=processes)
+        seconds = time.perf_counter() - start
+        parsed = sum(error is None for _, error in results)
+        print(f'\t{mode}: {seconds:.2f}s ({count / seconds:.1f} emails/s), {parsed} parsed')
+
+
+def concatenated_transaction_message(transaction, date_string):
+    '''
+    Returns the url scheme and the telegram message text of a parser's dict,
+    built by concatenation as before DC.MessageTemplate
+    '''
+    from urllib.parse import urlencode, quote
+
+    transaction = dict(transaction)
+    if "source_account" in transaction:
+        shortcuts_url = "dcapp://x-callback-url/transfer?"
+        text = "<b>Transferencia detectada</b>\n\n"
+    else:
+        transaction["account"] = "BBVA Crédito"
+        shortcuts_url = "dcapp://x-callback-url/expense?"
+        text = "<b>Gasto detectado</b>\n\n"
+    params = urlencode(transaction, quote_via=quote)
+    for key, item in transaction.items():
+        text += f"<b>{key.title()}</b>: {item}\n"
+    text += f"\n<b>Date</b>: {date_string}\n\n"
+    text += f"<b>D&C URL scheme</b>: {shortcuts_url+params}"
+    return shortcuts_url + params, text
+
+
+def compare_render(repeat):
+    '''
+    Times the messages of RENDER_TRANSACTIONS, repeat times, rendered from DC's
+    templates (from parser dicts and from ready transactions) and by concatenation
+    '''
+    import DC
+
+    date_string = '2026-10-18, 09:30'
+    transactions = [DC.Transaction.from_dict(transaction) for transaction in RENDER_TRANSACTIONS]
+    print(f'\nRendering {len(RENDER_TRANSACTIONS)} transactions {repeat} times')
+    for mode, render, values in (
+        ('templates', lambda transaction: DC.render_transaction(DC.Transaction.from_dict(transaction), date_string),
+         RENDER_TRANSACTIONS),
+        ('templates, ready transactions', lambda transaction: DC.render_transaction(transaction, date_string),
+         transactions),
+        ('concatenated', lambda transaction: concatenated_transaction_message(transaction, date_string),
+         RENDER_TRANSACTIONS)
+    ):
+        durations = []
+        for _ in range(repeat):
+            for value in values:
+                start = time.perf_counter()
+                render(value)
+                durations.append(time.perf_counter() - start)
+        print(f'\t{mode}: {sum(durations):.2f}s, '
+              f'p50 {percentile(durations, 0.5) * 1e6:.1f}us, '
+              f'p99 {percentile(durations, 0.99) * 1e6:.1f}us')
+
+
+def report(scale, counts, seconds, peak_bytes):
+    '''
+    Prints the results of one run
+    '''
+    print(f'\nScale {scale}x: peak memory {peak_bytes / 1024 / 1024:.1f} MB, '
+          f'max rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+    for job, count in counts.items():
+        print(f'\t{job}: {count} emails in {seconds[job]:.2f}s ({count / seconds[job]:.1f} emails/s)')
+    for stage, durations in sorted(DURATIONS.items()):
+        print(f'\t{stage}: {len(durations)} calls, '
+              f'p50 {percentile(durations, 0.5) * 1000:.2f}ms, '
+              f'p99 {percentile(durations, 0.99) * 1000:.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded corpus through the jobs and time every stage')
+    parser.add_argument('corpus', nargs='?', help='directory recorded with HTTP_RECORD_DIR')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 100, 10000],
+                        help='times every recorded email is listed')
+    parser.add_argument('--dc-folder', default=os.getenv('DEBIT_AND_CREDIT_FOLDER_ID'))
+    parser.add_argument('--ado-folder', default=os.getenv('ADO_FOLDER_ID'))
+    parser.add_argument('--html-parsers', action='store_true',
+                        help='compare html.parser and lxml on the parser test emails instead, needs no corpus')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='times every email is parsed with --html-parsers, or rendered with --render')
+    parser.add_argument('--pools', action='store_true',
+                        help='compare serial, thread and process parsing on the parser test emails instead, '
+                             'needs no corpus')
+    parser.add_argument('--emails', type=int, default=300,
+                        help='emails processed with --pools')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='threads and processes used with --pools')
+    parser.add_argument('--render', action='store_true',
+                        help='time the telegram messages of sample transactions instead, needs no corpus')
+    args = parser.parse_args()
+    if args.corpus is None and not (args.render or args.html_parsers or args.pools):
+        parser.error('a corpus is needed, except with --render, --html-parsers or --pools')
+
+    # Modules read their settings on import, so the environment goes first.
+    # Ledger, state and PDF cache live in a scratch directory, folders are listed in full
+    scratch = tempfile.mkdtemp(prefix='benchmark-')
+    if args.corpus is not None:
+        os.environ['HTTP_REPLAY_DIR'] = args.corpus
+    os.environ.pop('HTTP_RECORD_DIR', None)
+    os.environ.pop('MAIL_SYNC_MODE', None)
+    os.environ['LEDGER_PATH'] = os.path.join(scratch, 'ledger.sqlite3')
+    os.environ['STATE_PATH'] = os.path.join(scratch, 'state.sqlite3')
+    os.environ['PDF_CACHE_DIR'] = os.path.join(scratch, 'pdf_cache')
+    os.environ['DC_FAILURE_DIR'] = os.path.join(scratch, 'parser_failures')
+    os.environ.setdefault('TELEGRAM_CHAT_ID', 'benchmark')
+
+    if args.render:
+        compare_render(args.repeat)
+        return
+    if args.html_parsers:
+        compare_html_parsers(load_fixture_emails(), args.repeat)
+        return
+    if args.pools:
+        compare_pools(load_fixture_emails(), args.emails, args.workers)
+        return
+
+    import main as jobs
+    import ADO
+    import config
+    import fixtures
+    import telegram_sender
+
+    fixtures.CORPUS.stub('api.telegram.org', lambda method, url, kwargs: (200, {'ok': True}))
+    fixtures.CORPUS.stub(urlsplit(ADO.FACTURA_URL).netloc, ado_stand_in)
+    # The stand-in has no rate limit to respect
+    telegram_sender.CHAT_INTERVAL = 0
+    # Graph is a stand-in, so is the token
+    manager = jobs.TokenManager(config.DEFAULT_ACCOUNT)
+    manager.access_token, manager.expires_at = 'benchmark', float('inf')
+    jobs.TOKEN_MANAGERS[config.DEFAULT_ACCOUNT] = manager
+
+    for stage, module, name in STAGES:
+        owner = sys.modules[module]
+        *path, name = name.split('.')
+        for attribute in path:
+            owner = getattr(owner, attribute)
+        time_calls(stage, owner, name)
+
+    folders = load_emails(fixtures.CORPUS)
+    if args.dc_folder not in folders and args.ado_folder not in folders:
+        sys.exit(f'No recorded emails of the D&C or ADO folders in {args.corpus}')
+    for folder_id, emails in folders.items():
+        print(f'{len(emails)} recorded emails in {folder_id}')
+
+    for scale in args.scale:
+        tracemalloc.start()
+        counts, seconds = run(folders, scale, args.dc_folder, args.ado_folder, scratch)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report(scale, counts, seconds, peak_bytes)
+
+
+if __name__ == '__main__':
+    main()
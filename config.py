@@ -0,0 +1,55 @@
+'''
+Module with the configuration of the units of work.
+A unit is one job on one folder of one account. Units are read from the json
+file at AUTOMATION_CONFIG:
+
+    {"units": [
+        {"account": "hotmail", "job": "debit_and_credit", "folder_id": "..."},
+        {"account": "work", "job": "debit_and_credit", "folder_id": "...", "minutes": 5},
+        {"account": "hotmail", "job": "facturar_ado", "folder_id": "..."}
+    ]}
+
+Each account keeps its refresh token at refresh_tokens/{account} in firebase.
+Without a config file there's a single account, hotmail, with the D&C and ADO
+folders set in the environment
+'''
+
+import os
+import json
+
+
+CONFIG_PATH = os.getenv('AUTOMATION_CONFIG')
+DEFAULT_ACCOUNT = 'hotmail'
+
+DEBIT_AND_CREDIT = 'debit_and_credit'
+FACTURAR_ADO = 'facturar_ado'
+JOBS = (DEBIT_AND_CREDIT, FACTURAR_ADO)
+
+
+def load_units(path=CONFIG_PATH):
+    '''
+    Returns the configured units as {'account', 'job', 'folder_id'} dicts,
+    D&C units may also have the polling interval in 'minutes'
+    '''
+    if path is None:
+        return [
+            {'account': DEFAULT_ACCOUNT, 'job': DEBIT_AND_CREDIT, 'folder_id': os.getenv('DEBIT_AND_CREDIT_FOLDER_ID')},
+            {'account': DEFAULT_ACCOUNT, 'job': FACTURAR_ADO, 'folder_id': os.getenv('ADO_FOLDER_ID')}
+        ]
+
+    with open(path) as config_file:
+        units = json.load(config_file)['units']
+    for unit in units:
+        if unit.get('job') not in JOBS:
+            raise ValueError(f"Unknown job '{unit.get('job')}' in {path}")
+        if not unit.get('folder_id'):
+            raise ValueError(f"Unit without folder_id in {path}")
+        unit.setdefault('account', DEFAULT_ACCOUNT)
+    return units
+
+
+def unit_id(unit):
+    '''
+    Returns the scheduler job id of a unit
+    '''
+    return f"{unit['job']}:{unit['account']}:{unit['folder_id']}"
@@ -0,0 +1,151 @@
+'''
+Module with the record/replay layer of the http client.
+With HTTP_RECORD_DIR set, every response (Graph messages JSON, PDF bytes,
+ADO HTML) is written to a fixture corpus. With HTTP_REPLAY_DIR set, responses
+come from that corpus instead of the network, so the parsers and jobs can
+run offline
+'''
+
+import os
+import json
+import hashlib
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+RECORD_DIR = os.getenv('HTTP_RECORD_DIR')
+REPLAY_DIR = os.getenv('HTTP_REPLAY_DIR')
+
+# Requests to these hosts carry credentials, they are never written to the corpus
+PRIVATE_HOSTS = {'login.microsoftonline.com', 'api.telegram.org'}
+# Response headers that are not worth keeping
+SKIPPED_HEADERS = {'set-cookie', 'date', 'content-encoding', 'transfer-encoding'}
+
+
+class MissingFixtureError(Exception):
+    '''
+    Raised when replaying a request that was never recorded
+    '''
+
+
+def request_key(method, url, kwargs):
+    '''
+    Returns the key of a request: a hash of its method, url, params and body.
+    Headers are left out, so a different token still finds the fixture
+    '''
+    body = [kwargs.get('params'), kwargs.get('data'), kwargs.get('json')]
+    payload = json.dumps([method, url, body], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class Corpus:
+    '''
+    Directory of recorded responses, one {key}.json with the status and headers
+    and one {key}.body with the raw content per request
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # Stand-ins answering every request to a host, by host
+        self.stubs = {}
+        self.lock = threading.Lock()
+
+    def meta_path(self, key):
+        return os.path.join(self.path, f'{key}.json')
+
+    def body_path(self, key):
+        return os.path.join(self.path, f'{key}.body')
+
+    def record(self, method, url, kwargs, response):
+        '''
+        Stores a response. Streamed responses are read whole
+        '''
+        if urlsplit(url).netloc in PRIVATE_HOSTS:
+            return
+        key = request_key(method, url, kwargs)
+        meta = {
+            'method': method,
+            'url': url,
+            'status': response.status_code,
+            'headers': {
+                name: value for name, value in response.headers.items()
+                if name.lower() not in SKIPPED_HEADERS
+            }
+        }
+        content = response.content
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.body_path(key), 'wb') as body_file:
+                body_file.write(content)
+            with open(self.meta_path(key), 'w') as meta_file:
+                json.dump(meta, meta_file)
+
+    def stub(self, host, respond):
+        '''
+        Answers every request to host with respond(method, url, kwargs) instead of the corpus.
+        respond returns a (status, body) tuple, body being bytes, text, or anything
+        json serializable
+        '''
+        self.stubs[host] = respond
+
+    def replay(self, method, url, kwargs):
+        '''
+        Returns the stand-in response of a request if its host has one,
+        or its recorded response
+        '''
+        host = urlsplit(url).netloc
+        if host in self.stubs:
+            status, body = self.stubs[host](method, url, kwargs)
+            if isinstance(body, bytes):
+                content_type = 'application/octet-stream'
+            elif isinstance(body, str):
+                content_type, body = 'text/html; charset=utf-8', body.encode()
+            else:
+                content_type, body = 'application/json', json.dumps(body).encode()
+            return build_response(url, {'status': status, 'headers': {'Content-Type': content_type}}, body)
+
+        key = request_key(method, url, kwargs)
+        try:
+            with open(self.meta_path(key)) as meta_file:
+                meta = json.load(meta_file)
+            with open(self.body_path(key), 'rb') as body_file:
+                body = body_file.read()
+        except FileNotFoundError:
+            raise MissingFixtureError(f'No fixture for {method} {url}')
+        return build_response(url, meta, body)
+
+    def responses(self):
+        '''
+        Yields (meta, body) for every recorded response
+        '''
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            with open(self.meta_path(key)) as meta_file:
+                meta = json.load(meta_file)
+            with open(self.body_path(key), 'rb') as body_file:
+                yield meta, body_file.read()
+
+
+def build_response(url, meta, body):
+    '''
+    Builds a requests response with the given content, already read,
+    so .json(), .text and iter_content() work like on a real one
+    '''
+    response = requests.Response()
+    response.url = url
+    response.status_code = meta['status']
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
+# Corpus the http client records to or replays from, if any
+CORPUS = Corpus(REPLAY_DIR or RECORD_DIR) if REPLAY_DIR or RECORD_DIR else None
+REPLAYING = REPLAY_DIR is not None
@@ -0,0 +1,171 @@
+'''
+Module with the shared http client used for every outbound call.
+Keeps a keep-alive connection pool per host, sets default timeouts,
+retries with backoff and counts requests and latency per host.
+Responses can be recorded to or replayed from a fixture corpus, see fixtures
+'''
+
+import time
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import fixtures
+
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+# Max idle connections kept per host
+POOL_SIZE = 10
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Methods that are safe to send twice
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+
+# Per host counters, shared by every client
+STATS = {}
+STATS_LOCK = threading.Lock()
+
+
+def record(host, seconds, error=False, retry=False):
+    '''
+    Adds a request to the counters of the given host
+    '''
+    with STATS_LOCK:
+        host_stats = STATS.setdefault(host, {
+            'requests': 0,
+            'errors': 0,
+            'retries': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0
+        })
+        host_stats['requests'] += 1
+        host_stats['errors'] += int(error)
+        host_stats['retries'] += int(retry)
+        host_stats['total_seconds'] += seconds
+        host_stats['max_seconds'] = max(host_stats['max_seconds'], seconds)
+
+
+def stats():
+    '''
+    Returns a copy of the per host counters
+    '''
+    with STATS_LOCK:
+        return {host: dict(host_stats) for host, host_stats in STATS.items()}
+
+
+class HTTPClient:
+    '''
+    Pooled http client with default timeouts and retries.
+    Non idempotent requests (POST) are only retried when the server
+    throttled them or the connection could not be made, since in those
+    cases they were never processed
+    '''
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Makes a request, retrying on 429, 5xx and connection errors
+        '''
+        method = method.upper()
+        host = urlsplit(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+
+        if fixtures.REPLAYING:
+            return fixtures.CORPUS.replay(method, url, kwargs)
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.ConnectionError as error:
+                # A read timeout may have reached the server, connection errors did not
+                retryable = method in IDEMPOTENT_METHODS or isinstance(error, requests.exceptions.ConnectTimeout)
+                record(host, time.monotonic() - start, error=True, retry=retryable and not last_attempt)
+                if not retryable or last_attempt:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+            except requests.exceptions.Timeout:
+                record(host, time.monotonic() - start, error=True, retry=method in IDEMPOTENT_METHODS and not last_attempt)
+                if method not in IDEMPOTENT_METHODS or last_attempt:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            status = response.status_code
+            retryable = status == 429 or (status in RETRY_STATUSES and method in IDEMPOTENT_METHODS)
+            record(host, time.monotonic() - start, error=status >= 500, retry=retryable and not last_attempt)
+            if not retryable or last_attempt:
+                if fixtures.CORPUS is not None:
+                    fixtures.CORPUS.record(method, url, kwargs, response)
+                return response
+
+            # Respect Retry-After when the server sends it in seconds
+            retry_after = response.headers.get('Retry-After', '')
+            delay = int(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+            response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        '''
+        Makes a GET request
+        '''
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        '''
+        Makes a POST request
+        '''
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        '''
+        Makes a DELETE request
+        '''
+        return self.request('DELETE', url, **kwargs)
+
+
+# Default client shared by all modules
+CLIENT = HTTPClient()
+
+
+def request(method, url, **kwargs):
+    '''
+    Makes a request with the shared client
+    '''
+    return CLIENT.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    '''
+    Makes a GET request with the shared client
+    '''
+    return CLIENT.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    '''
+    Makes a POST request with the shared client
+    '''
+    return CLIENT.post(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    '''
+    Makes a DELETE request with the shared client
+    '''
+    return CLIENT.delete(url, **kwargs)
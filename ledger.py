@@ -0,0 +1,236 @@
+'''
+Module with the local ledger of processed work.
+Keeps track of which emails were already notified and deleted, and which
+ADO folios were already invoiced, so a re-run after a crash skips what
+already finished and resumes what didn't.
+Also keeps the index of ADO tickets collected from emails, by month,
+and the delta link the collection continues from
+'''
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+LEDGER_PATH = os.getenv('LEDGER_PATH', 'ledger.sqlite3')
+
+# Message statuses
+PROCESSED = 'processed'
+DELETED = 'deleted'
+
+# Folio statuses
+# INVOICING means the invoice request was sent but no answer was recorded,
+# so it may or may not have gone through and must be checked by hand
+INVOICING = 'invoicing'
+INVOICED = 'invoiced'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    folder_id TEXT NOT NULL,
+    subject TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_folder_status ON messages (folder_id, status);
+CREATE TABLE IF NOT EXISTS notifications (
+    message_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sent_at REAL NOT NULL,
+    PRIMARY KEY (message_id, position)
+);
+CREATE TABLE IF NOT EXISTS folios (
+    folio TEXT PRIMARY KEY,
+    message_id TEXT,
+    status TEXT NOT NULL,
+    pdf_link TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tickets (
+    folio TEXT PRIMARY KEY,
+    folder_id TEXT,
+    month TEXT,
+    message_id TEXT NOT NULL,
+    ticket TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS collected (
+    message_id TEXT PRIMARY KEY,
+    collected_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS delta_links (
+    folder_id TEXT PRIMARY KEY,
+    delta_link TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+'''
+
+
+class Ledger:
+    '''
+    SQLite backed ledger indexed by Graph message id and by ADO folio
+    '''
+
+    def __init__(self, path=LEDGER_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            # Ticket indexes made before tickets were kept by folder
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(tickets)')]
+            if 'folder_id' not in columns:
+                self.connection.execute('ALTER TABLE tickets ADD COLUMN folder_id TEXT')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS tickets_folder_month ON tickets (folder_id, month)')
+
+    def execute(self, query, params=()):
+        '''
+        Runs a query in its own transaction and returns all its rows
+        '''
+        with self.lock, self.connection:
+            return self.connection.execute(query, params).fetchall()
+
+    def message_status(self, message_id):
+        '''
+        Returns the status of a message, or None if it was never processed
+        '''
+        rows = self.execute('SELECT status FROM messages WHERE message_id = ?', (message_id,))
+        return rows[0][0] if rows else None
+
+    def mark_message(self, email, folder_id, status):
+        '''
+        Sets the status of a message
+        '''
+        self.execute(
+            'INSERT OR REPLACE INTO messages (message_id, folder_id, subject, status, updated_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (email['id'], folder_id, email.get('subject'), status, time.time())
+        )
+
+    def pending_deletes(self, folder_id, after='', limit=-1):
+        '''
+        Returns the messages of a folder that were processed but not deleted yet,
+        as {'id', 'subject'} dicts ordered by id.
+        Only those with an id greater than after are returned, at most limit of them
+        (no limit by default), so they can be read a page at a time
+        '''
+        rows = self.execute(
+            'SELECT message_id, subject FROM messages WHERE folder_id = ? AND status = ? AND message_id > ? '
+            'ORDER BY message_id LIMIT ?',
+            (folder_id, PROCESSED, after, limit)
+        )
+        return [{'id': message_id, 'subject': subject} for message_id, subject in rows]
+
+    def is_notified(self, message_id, position):
+        '''
+        Returns whether the transaction at position of a message was already notified
+        '''
+        rows = self.execute(
+            'SELECT 1 FROM notifications WHERE message_id = ? AND position = ?',
+            (message_id, position)
+        )
+        return bool(rows)
+
+    def mark_notified(self, message_id, position):
+        '''
+        Records that the transaction at position of a message was notified
+        '''
+        self.execute(
+            'INSERT OR REPLACE INTO notifications (message_id, position, sent_at) VALUES (?, ?, ?)',
+            (message_id, position, time.time())
+        )
+
+    def folio_status(self, folio):
+        '''
+        Returns the status of a folio, or None if it was never invoiced
+        '''
+        rows = self.execute('SELECT status FROM folios WHERE folio = ?', (folio,))
+        return rows[0][0] if rows else None
+
+    def mark_folios(self, tickets, status, pdf_link=None):
+        '''
+        Sets the status of the folios of the given tickets
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO folios (folio, message_id, status, pdf_link, updated_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(ticket['folio'], ticket.get('email_id'), status, pdf_link, now) for ticket in tickets]
+            )
+
+    def claim_folios(self, tickets):
+        '''
+        Marks as INVOICING the folios of the given tickets that were never invoiced
+        or whose invoicing failed, all at once, so no other run can take them.
+        Returns the tickets that were claimed
+        '''
+        now = time.time()
+        claimed = []
+        with self.lock, self.connection:
+            for ticket in tickets:
+                cursor = self.connection.execute(
+                    'INSERT INTO folios (folio, message_id, status, pdf_link, updated_at) VALUES (?, ?, ?, NULL, ?) '
+                    'ON CONFLICT (folio) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at '
+                    'WHERE folios.status = ?',
+                    (ticket['folio'], ticket.get('email_id'), INVOICING, now, FAILED)
+                )
+                if cursor.rowcount:
+                    claimed.append(ticket)
+        return claimed
+
+    def is_collected(self, message_id):
+        '''
+        Returns whether the tickets of an ADO email were already collected
+        '''
+        rows = self.execute('SELECT 1 FROM collected WHERE message_id = ?', (message_id,))
+        return bool(rows)
+
+    def add_tickets(self, message_id, folder_id, tickets, months):
+        '''
+        Stores the tickets of an ADO email from a folder, each under its month ('YYYY-MM',
+        None if its date can't be read), and records the email as collected
+        '''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO tickets (folio, folder_id, month, message_id, ticket) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (ticket['folio'], folder_id, month, message_id, json.dumps(ticket))
+                    for ticket, month in zip(tickets, months)
+                ]
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO collected (message_id, collected_at) VALUES (?, ?)',
+                (message_id, time.time())
+            )
+
+    def tickets_between(self, folder_id, first_month, end_month):
+        '''
+        Returns the tickets collected from a folder from first_month up to end_month
+        (not included), both 'YYYY-MM' strings
+        '''
+        rows = self.execute(
+            'SELECT ticket FROM tickets WHERE folder_id = ? AND month >= ? AND month < ? ORDER BY month, folio',
+            (folder_id, first_month, end_month)
+        )
+        return [json.loads(ticket) for ticket, in rows]
+
+    def delta_link(self, folder_id):
+        '''
+        Returns the delta link the collection of a folder continues from, or None
+        '''
+        rows = self.execute('SELECT delta_link FROM delta_links WHERE folder_id = ?', (folder_id,))
+        return rows[0][0] if rows else None
+
+    def save_delta_link(self, folder_id, delta_link):
+        '''
+        Stores the delta link of a folder, so next collection starts from there
+        '''
+        self.execute(
+            'INSERT OR REPLACE INTO delta_links (folder_id, delta_link, updated_at) VALUES (?, ?, ?)',
+            (folder_id, delta_link, time.time())
+        )
+
+
+LEDGER = Ledger()
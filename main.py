@@ -3,59 +3,93 @@ Main personal automation module
 '''
 
 import os
-import re
-import urllib
+import sys
+import time
+import asyncio
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import parsedate_to_datetime
 
-from datetime import timedelta
 from pprint import pprint as pp
 
 import pytz
-import nltk
-import requests
-import firebase_admin
-
-from bs4 import BeautifulSoup
-from firebase_admin import db, credentials
-from apscheduler.schedulers.blocking import BlockingScheduler
-from PyPDF2.utils import PdfReadError
 
 import DC
 import ADO
+import state
+import config
+import ledger
+import metrics
+import http_client
+import telegram_sender
 
+# Heavy dependencies (firebase_admin, apscheduler, bs4, PyPDF2) are imported
+# by the code that needs them, so the clock process starts fast
 
 
-SCHED = BlockingScheduler()
 MEXICO_CITY_TIMEZONE = pytz.timezone('America/Mexico_City')
 
 # APIs
 MS_GRAPH_URL = "https://graph.microsoft.com/v1.0"
-TELEGRAM_URL = "https://api.telegram.org"
-
-# URL Schemes
-DC_EXPENSE_URL_SCHEME = "dcapp://x-callback-url/expense?"
-DC_TRANSFER_URL_SCHEME = "dcapp://x-callback-url/transfer?"
-
-# Months!
-MONTHS = {
-    'ENE': '01',
-    'FEB': '02',
-    'MAR': '03',
-    'ABR': '04',
-    'MAY': '05',
-    'JUN': '06',
-    'JUL': '07',
-    'AGO': '08',
-    'SEP': '09',
-    'OCT': '10',
-    'NOV': '11',
-    'DIC': '12'
-}
+
+# Graph $batch allows up to 20 requests per call
+GRAPH_BATCH_SIZE = 20
+GRAPH_BATCH_RETRIES = 3
+GRAPH_BATCH_BACKOFF = 1
+
+# Emails are listed a page at a time, with only the fields the jobs use
+MAIL_PAGE_SIZE = int(os.getenv('MAIL_PAGE_SIZE', '50'))
+MAIL_FIELDS = 'id,subject,sender,body'
+
+# Event driven mode, enabled when Graph can reach this process at GRAPH_NOTIFICATION_URL.
+# On Heroku only the web process gets HTTP traffic, so the work is split by process type:
+# web runs D&C (listener included) when notifications are enabled, and clock runs ADO,
+# plus D&C when they're not. Without a process type everything runs in one process
+NOTIFICATION_URL = os.getenv('GRAPH_NOTIFICATION_URL')
+WEB = 'web'
+CLOCK = 'clock'
+LISTENER = None
+# Notifications and polling must never process the same folder at the same time,
+# one lock per folder
+FOLDER_LOCKS = {}
+FOLDER_LOCKS_LOCK = threading.Lock()
+
+# New ADO emails are collected this often, the monthly invoicing only reads what was collected
+ADO_COLLECT_MINUTES = int(os.getenv('ADO_COLLECT_MINUTES', '60'))
+# Position under which unread ticket pages are recorded as notified, no transaction has it
+UNREAD_PAGES = -1
+
+# Misfire grace times in seconds: a D&C run that couldn't start in time is
+# dropped for the next one, an ADO run still happens if it's late
+DC_MISFIRE_GRACE_TIME = 30
+ADO_MISFIRE_GRACE_TIME = 6 * 3600
+
+# Async D&C pipeline, enabled with DC_PIPELINE=async
+# Each stage has its own number of workers, and queues between stages
+# hold at most PIPELINE_QUEUE_SIZE emails so a fast stage waits for a slow one
+PIPELINE_PARSE_WORKERS = int(os.getenv('DC_PIPELINE_PARSE_WORKERS', '4'))
+PIPELINE_NOTIFY_WORKERS = int(os.getenv('DC_PIPELINE_NOTIFY_WORKERS', '1'))
+PIPELINE_DELETE_WORKERS = int(os.getenv('DC_PIPELINE_DELETE_WORKERS', '1'))
+PIPELINE_QUEUE_SIZE = int(os.getenv('DC_PIPELINE_QUEUE_SIZE', '20'))
+
+# Metrics are served at METRICS_PORT when set, and printed periodically
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_SUMMARY_MINUTES = int(os.getenv('METRICS_SUMMARY_MINUTES', '60'))
+
+# Firebase is initialized on first use
+FIREBASE_LOCK = threading.Lock()
+FIREBASE_INITIALIZED = False
+
 
 def initialize_firebase():
     '''
     Iniitializes fiirebase with .env values
     '''
+    import firebase_admin
+    from firebase_admin import credentials
+
     cert = credentials.Certificate({
         'type': 'service_account',
         'token_uri': 'https://oauth2.googleapis.com/token',
@@ -64,254 +98,646 @@ def initialize_firebase():
     })
     firebase_admin.initialize_app(cert, {'databaseURL': os.getenv('DATABASE_URL')})
 
-def get_token():
+
+def get_db():
     '''
-    Gets a new valid token and stores a new refresh token
+    Returns firebase's db module, initializing firebase the first time
     '''
-    print('Getting new token...')
-    # get refresh token
-    refresh_token = db.reference('refresh_tokens/hotmail').get()
-    # list token scopes
-    scopes = [
-        'offline_access',
-        'user.readwrite',
-        'mail.read',
-        'mail.send',
-        'mail.readwrite'
-    ]
-    # build POST parameters
-    params = {
-        'client_id': os.getenv('CLIENT_ID'),
-        'scope': ' '.join(scopes),
-        'refresh_token': refresh_token,
-        'redirect_uri': 'http://localhost:5000/',
-        'client_secret': os.getenv('CLIENT_SECRET'),
-        'grant_type': 'refresh_token'
-    }
-    # Make POST request to MS
-    url = 'https://login.microsoftonline.com/consumers/oauth2/v2.0/token'
-    response = requests.post(url, data=params).json()
+    global FIREBASE_INITIALIZED
+    with FIREBASE_LOCK:
+        if not FIREBASE_INITIALIZED:
+            initialize_firebase()
+            FIREBASE_INITIALIZED = True
+
+    from firebase_admin import db
+    return db
+
+
+# Firebase values are read from and written to a local cache first
+STATE = state.StateStore(remote=get_db)
+
+
+class TokenManager:
+    '''
+    Keeps the current access token of an account in memory and only refreshes it
+    shortly before it expires
+    '''
+
+    # Refresh this many seconds before the token actually expires
+    REFRESH_MARGIN = 300
+
+    def __init__(self, account=config.DEFAULT_ACCOUNT):
+        self.refresh_token_key = f'refresh_tokens/{account}'
+        self.access_token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''
+        Returns a valid access token, refreshing it if needed.
+        Only one refresh runs at a time, other callers wait for it
+        '''
+        with self.lock:
+            if self.access_token is None or time.monotonic() >= self.expires_at - self.REFRESH_MARGIN:
+                with metrics.span('token_refresh'):
+                    self.refresh()
+            return self.access_token
+
+    def refresh(self):
+        '''
+        Gets a new valid token and stores a new refresh token
+        '''
+        print('Getting new token...')
+        # get refresh token
+        refresh_token = STATE.get(self.refresh_token_key)
+        # list token scopes
+        scopes = [
+            'offline_access',
+            'user.readwrite',
+            'mail.read',
+            'mail.send',
+            'mail.readwrite'
+        ]
+        # build POST parameters
+        params = {
+            'client_id': os.getenv('CLIENT_ID'),
+            'scope': ' '.join(scopes),
+            'refresh_token': refresh_token,
+            'redirect_uri': 'http://localhost:5000/',
+            'client_secret': os.getenv('CLIENT_SECRET'),
+            'grant_type': 'refresh_token'
+        }
+        # Make POST request to MS
+        url = 'https://login.microsoftonline.com/consumers/oauth2/v2.0/token'
+        response = http_client.post(url, data=params).json()
+
+        # Refresh token may have been rotated by someone else, read it from firebase next time
+        if 'refresh_token' not in response:
+            STATE.invalidate(self.refresh_token_key)
+            raise RuntimeError(f"Could not refresh token: {response.get('error_description')}")
+
+        # Store new refresh token, locally and then in firebase
+        STATE.set(self.refresh_token_key, response['refresh_token'])
+
+        # Keep access token and its expiration time
+        self.access_token = response['access_token']
+        self.expires_at = time.monotonic() + int(response.get('expires_in', 3600))
+
+
+# One token manager per account
+TOKEN_MANAGERS = {}
+TOKEN_MANAGERS_LOCK = threading.Lock()
+
+def get_token(account=config.DEFAULT_ACCOUNT):
+    '''
+    Gets a valid access token of an account, only refreshing it when it's about to expire
+    '''
+    with TOKEN_MANAGERS_LOCK:
+        if account not in TOKEN_MANAGERS:
+            TOKEN_MANAGERS[account] = TokenManager(account)
+        manager = TOKEN_MANAGERS[account]
+    return manager.get()
+
+def load_delta_link(folder_id):
+    '''
+    Returns the delta link saved for a D&C folder, or None if there's none
+    '''
+    return STATE.get(f'delta_links/{folder_id}')
 
-    # Get new refresh token from response
-    refresh_token = response['refresh_token']
 
-    # Store new refresh token in firebase
-    db_ref = db.reference('/refresh_tokens')
-    db_ref.update({'hotmail': refresh_token})
+def save_delta_link(folder_id, delta_link):
+    '''
+    Stores the delta link of a D&C folder, so next sync starts from there
+    '''
+    STATE.set(f'delta_links/{folder_id}', delta_link)
 
-    # return access_token
-    return response['access_token']
 
-def gather_emails(token, folder_id):
+def iter_folder_pages(token, folder_id, saved_delta_link=load_delta_link):
     '''
-    Gathers all outlook emails within a folder
+    Yields every page of a folder listing, following @odata.nextLink.
+    Uses the sync mode set in MAIL_SYNC_MODE: with 'delta' the listing starts from
+    the delta link saved_delta_link(folder_id) returns (from scratch if None), only
+    has emails added since then, and its last page has the new @odata.deltaLink;
+    otherwise every email in the folder is listed.
+    Pages have at most MAIL_PAGE_SIZE emails with only MAIL_FIELDS in them
     '''
     headers = {
-        'Authorization': token
+        'Authorization': token,
+        # Delta queries don't take $top, their page size is set here
+        'Prefer': f'odata.maxpagesize={MAIL_PAGE_SIZE}'
     }
-    response = requests.get(f'{MS_GRAPH_URL}/me/mailFolders/{folder_id}/messages', headers=headers)
-    emails = response.json()['value']
-    return emails
+    if os.getenv('MAIL_SYNC_MODE') == 'delta':
+        # Start from last delta link, or from scratch if there's none.
+        # $select is kept by Graph in the next and delta links
+        url = saved_delta_link(folder_id)
+        if url is None:
+            url = f'{MS_GRAPH_URL}/me/mailFolders/{folder_id}/messages/delta?$select={MAIL_FIELDS}'
+    else:
+        url = f'{MS_GRAPH_URL}/me/mailFolders/{folder_id}/messages?$select={MAIL_FIELDS}&$top={MAIL_PAGE_SIZE}'
+
+    while url:
+        with metrics.span('graph_fetch'):
+            response = http_client.get(url, headers=headers)
+        metrics.inc('bytes_downloaded', len(response.content), source='graph')
+        page = response.json()
+        # Deleted or moved messages come back as '@removed' in delta mode, skip them
+        page['value'] = [email for email in page['value'] if '@removed' not in email]
+        yield page
+        url = page.get('@odata.nextLink')
+
+
+def is_retryable(status):
+    '''
+    Returns whether a Graph status is worth retrying: throttling or a server error
+    '''
+    return status == 429 or status >= 500
+
+
+def retry_after_seconds(headers):
+    '''
+    Returns the seconds a Retry-After header asks to wait, in seconds or as an HTTP date.
+    0 if it's missing or can't be read
+    '''
+    retry_after = headers.get('Retry-After', '')
+    if str(retry_after).isdigit():
+        return int(retry_after)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return 0
+    if retry_at.tzinfo is None:
+        return 0
+    return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
 
 
 def delete_emails_in_folder(emails, token, folder_id):
     '''
-    Deletes all given emails from the given folder
+    Deletes all given emails from the given folder using Graph's $batch endpoint.
+    Items throttled or failed by the server are retried with backoff.
+    Returns the list of emails that were actually deleted
     '''
     headers = {
         'Authorization': token
     }
-    for email in emails:
-        subject = email['subject']
-        email_id = email['id']
-
-        print(f'Deleting {subject}... ', end='')
-        url = f'{MS_GRAPH_URL}/me/mailFolders/{folder_id}/messages/{email_id}'
-        response = requests.delete(url, headers=headers)
-        print(response.status_code)
+    deleted = []
+    for start in range(0, len(emails), GRAPH_BATCH_SIZE):
+        pending = {str(i): email for i, email in enumerate(emails[start:start + GRAPH_BATCH_SIZE])}
+
+        for attempt in range(GRAPH_BATCH_RETRIES + 1):
+            body = {
+                'requests': [{
+                    'id': request_id,
+                    'method': 'DELETE',
+                    'url': f'/me/mailFolders/{folder_id}/messages/{email["id"]}'
+                } for request_id, email in pending.items()]
+            }
+            with metrics.span('graph_delete'):
+                response = http_client.post(f'{MS_GRAPH_URL}/$batch', headers=headers, json=body)
+
+            # Whole batch throttled or failed by the server, retry every item in it.
+            # Any other error won't go away by retrying
+            if not response.ok:
+                print(f'Batch delete failed with {response.status_code}')
+                if not is_retryable(response.status_code):
+                    break
+                retry_after = retry_after_seconds(response.headers)
+            else:
+                retry_after = 0
+                for item in response.json()['responses']:
+                    email = pending[item['id']]
+                    status = item['status']
+                    print(f'Deleting {email["subject"]}... {status}')
+                    # Retry throttled and server errors, anything else is final
+                    if is_retryable(status):
+                        retry_after = max(retry_after, retry_after_seconds(item.get('headers', {})))
+                        continue
+                    del pending[item['id']]
+                    # 404 means it was already gone
+                    if status < 300 or status == 404:
+                        deleted.append(email)
+
+            if not pending or attempt == GRAPH_BATCH_RETRIES:
+                break
+            time.sleep(max(retry_after, GRAPH_BATCH_BACKOFF * 2 ** attempt))
+
+        for email in pending.values():
+            print(f'Could not delete {email["subject"]}')
+
+    return deleted
 
 
 def send_telegram_message(text):
     '''
     Sends a telegram message via PersonalAutomationBot to myself
-    It parses text as html
+    It parses text as html. Waits for it to go through the outbound queue
+    and returns whether it was sent
     '''
-    data = {
-        "chat_id": os.getenv("TELEGRAM_CHAT_ID"),
-        "text": text,
-        "parse_mode": "html"
-    }
-    url = f'{TELEGRAM_URL}/bot{os.getenv("TELEGRAM_BOT_TOKEN")}/sendMessage'
-    requests.post(url, data=data)
+    return telegram_sender.SENDER.send(text).result()
 
 
-@SCHED.scheduled_job('interval', minutes=1)
-def debit_and_credit_automation():
+def message_timestamp():
     '''
-    Checks every minute for an email in D&C folder,
-    extracts transaction information, builds an url schema for D&C,
-    and sends it through telegram
+    Returns the date shown in transaction messages, taken once per batch of them
     '''
-    print("Debit & Credit automation...")
-    token = get_token()
-    emails = gather_emails(token, os.getenv('DEBIT_AND_CREDIT_FOLDER_ID'))
+    return datetime.datetime.now(MEXICO_CITY_TIMEZONE).strftime("%Y-%m-%d, %H:%M")
 
-    # Build transactions from emails
-    transactions = []
-    emails_to_be_deleted = []
-    for email in emails:
-
-        # If no rule found, just skip to next email
-        try:
-            transaction = DC.process_email(email)
-        except Exception:
-            continue
 
-        if type(transaction) == dict:
-            transactions.append(transaction)
-        elif type(transaction) == list:
-            transactions.extend(transaction)
+def build_transaction_message(transaction, date_string=None):
+    '''
+    Builds the telegram message text of a transaction, with its D&C url scheme.
+    Takes a parser's dict or a DC.Transaction
+    '''
+    if isinstance(transaction, dict):
+        transaction = DC.Transaction.from_dict(transaction)
+    _, text = DC.render_transaction(transaction, date_string or message_timestamp())
+    return text
 
-        # Add email to delete list
-        emails_to_be_deleted.append(email)
 
-    # Send all transactions as url-schemes via telegram
-    for transaction in transactions:
+def count_parse_result(error):
+    '''
+    Counts an email as parsed, skipped (no rule for it) or failed
+    '''
+    if error is None:
+        metrics.inc('emails_parsed')
+    elif isinstance(error, DC.NoRuleError):
+        metrics.inc('emails_skipped')
+    else:
+        metrics.inc('emails_failed')
 
-        # Check if it's a transfer by looking for "source_account" in dict
-        if "source_account" in transaction:
-            shortcuts_url = DC_TRANSFER_URL_SCHEME
-            text = "<b>Transferencia detectada</b>\n\n"
-        # Else, it's an expene
-        else:
-            transaction["account"] = "BBVA Crédito"
-            shortcuts_url = DC_EXPENSE_URL_SCHEME
-            text = "<b>Gasto detectado</b>\n\n"
 
-        # build url-scheme
-        params = urllib.parse.urlencode(transaction, quote_via=urllib.parse.quote)
+@metrics.timed('job', job='debit_and_credit')
+def debit_and_credit_automation(account=config.DEFAULT_ACCOUNT, folder_id=None):
+    '''
+    Checks for an email in a D&C folder of an account (by default the one in
+    DEBIT_AND_CREDIT_FOLDER_ID), extracts transaction information,
+    builds an url schema for D&C, and sends it through telegram
+    '''
+    print("Debit & Credit automation...")
+    folder_id = folder_id or os.getenv('DEBIT_AND_CREDIT_FOLDER_ID')
+    token = get_token(account)
+
+    if os.getenv('DC_PIPELINE') == 'async':
+        asyncio.run(debit_and_credit_pipeline(token, folder_id))
+        print("Debit & Credit Done.\n")
+        return
+
+    # Emails are handled a page at a time and released, so a big backlog
+    # takes as much memory as a single page
+    delta_link = None
+    complete = True
+    for page in iter_folder_pages(token, folder_id):
+        delta_link = page.get('@odata.deltaLink', delta_link)
+        complete = process_page(page['value'], folder_id) and complete
+
+    # Deleting while listing would shift the pages, so processed emails are
+    # deleted afterwards, including any left undeleted by a previous run
+    all_deleted = delete_pending_emails(token, folder_id)
+
+    # Next sync only needs what arrives after this run,
+    # unless some email couldn't be parsed, sent or deleted and has to be seen again
+    if delta_link is not None and complete and all_deleted:
+        save_delta_link(folder_id, delta_link)
+    print("Debit & Credit Done.\n")
 
-        # Build message text with format
 
-        '''
-        <b>[transation] detectadx</b>
+def process_page(emails, folder_id):
+    '''
+    Processes a page of D&C emails: parses them, sends their transactions
+    and records in the ledger those that are done.
+    Returns whether every email was done, emails without a rule don't count
+    '''
+    metrics.inc('emails_seen', len(emails))
 
-        <b>Param1</b>: value1
-        <b>Param2</b>: value2...
+    # Emails processed on a previous run only need to be deleted
+    new_emails = [email for email in emails if ledger.LEDGER.message_status(email['id']) is None]
 
-        <b>Date</b>: Date
+    # Build transactions from emails
+    processed_emails = []
+    complete = True
+    with metrics.span('parse'):
+        results = DC.process_emails(new_emails)
+    for email, (transaction, error) in zip(new_emails, results):
+        count_parse_result(error)
+
+        # If no rule found, just skip to next email.
+        # Any other error means it has to be tried again
+        if error is not None:
+            complete = complete and isinstance(error, DC.NoRuleError)
+            continue
 
-        <b>URL scheme</b>: D&C URL scheme
-        '''
+        if type(transaction) == dict:
+            transaction = [transaction]
+        processed_emails.append((email, transaction))
+
+    # Send all transactions as url-schemes via telegram, queueing them all first
+    # so they can be merged, emails whose transactions were all sent are done, and can be deleted
+    date_string = message_timestamp()
+    queued = [
+        (email, notify_transactions(email, transactions, date_string))
+        for email, transactions in processed_emails
+    ]
+    for email, futures in queued:
+        if all([future.result() for future in futures]):
+            ledger.LEDGER.mark_message(email, folder_id, ledger.PROCESSED)
+        else:
+            complete = False
+    return complete
 
-        for key, item in transaction.items():
-            text += f"<b>{key.title()}</b>: {item}\n"
-        # Add current date
-        date_string = datetime.datetime.now(MEXICO_CITY_TIMEZONE).strftime("%Y-%m-%d, %H:%M")
-        text += f"\n<b>Date</b>: {date_string}\n\n"
-        # Add URL scheme
-        text += f"<b>D&C URL scheme</b>: {shortcuts_url+params}"
-        # Send message
-        send_telegram_message(text)
 
-    # delete emails
-    delete_emails_in_folder(emails_to_be_deleted, token, os.getenv('DEBIT_AND_CREDIT_FOLDER_ID'))
-    print("Debit & Credit Done.\n")
+def delete_pending_emails(token, folder_id):
+    '''
+    Deletes the emails of a folder the ledger has as processed but not deleted,
+    reading them from the ledger one batch at a time.
+    Returns whether all of them were deleted
+    '''
+    all_deleted = True
+    after = ''
+    while True:
+        emails = ledger.LEDGER.pending_deletes(folder_id, after=after, limit=GRAPH_BATCH_SIZE)
+        if not emails:
+            return all_deleted
+        deleted = delete_emails_in_folder(emails, token, folder_id)
+        for email in deleted:
+            ledger.LEDGER.mark_message(email, folder_id, ledger.DELETED)
+        all_deleted = all_deleted and len(deleted) == len(emails)
+        after = emails[-1]['id']
+
+
+def notify_transactions(email, transactions, date_string=None):
+    '''
+    Queues the transactions of an email via telegram, skipping those already sent.
+    Each one is recorded in the ledger once delivered.
+    date_string is the date shown in the messages, now by default.
+    Returns the futures of the queued messages
+    '''
+    def record(position):
+        def callback(future):
+            if future.result():
+                ledger.LEDGER.mark_notified(email['id'], position)
+        return callback
+
+    futures = []
+    date_string = date_string or message_timestamp()
+    for position, transaction in enumerate(transactions):
+        if ledger.LEDGER.is_notified(email['id'], position):
+            continue
+        future = telegram_sender.SENDER.send(build_transaction_message(transaction, date_string))
+        future.add_done_callback(record(position))
+        futures.append(future)
+    return futures
 
 
-@SCHED.scheduled_job('cron', day=1, hour=9, minute=30, second=0, timezone=MEXICO_CITY_TIMEZONE)
-def facturar_ado():
+async def debit_and_credit_pipeline(token, folder_id):
     '''
-    Processes ADO emails, extracts info from their pdfs, and sends them to ADO
+    Async version of the D&C automation.
+    Streams each email through parse, notify and delete as soon as its page is fetched,
+    with a bounded number of workers per stage and bounded queues between stages.
+    Without delta sync, deletes wait until the whole folder is listed.
+    Parsers run in an executor, same as the blocking network calls
     '''
-    print("Facturando ADO...")
+    loop = asyncio.get_running_loop()
+    parse_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    notify_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    delete_queue = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+    # Anything left undone means the delta link can't move forward
+    progress = {'complete': True, 'delta_link': None}
+    # Deleting while listing would shift the $skip pages of a full listing, so there processed
+    # emails are deleted once it's done. Delta pages don't shift, deletes go right away
+    delete_now = os.getenv('MAIL_SYNC_MODE') == 'delta'
+
+    thread_pool = ThreadPoolExecutor(PIPELINE_PARSE_WORKERS + PIPELINE_NOTIFY_WORKERS + PIPELINE_DELETE_WORKERS + 1)
+    process_pool = DC.get_process_pool(DC.PARSE_PROCESSES)
+
+    async def fetch():
+        pages = iter_folder_pages(token, folder_id)
+        while True:
+            page = await loop.run_in_executor(thread_pool, next, pages, None)
+            if page is None:
+                break
+            progress['delta_link'] = page.get('@odata.deltaLink', progress['delta_link'])
+            metrics.inc('emails_seen', len(page['value']))
+            for email in page['value']:
+                status = ledger.LEDGER.message_status(email['id'])
+                # Emails processed on a previous run only need to be deleted
+                if status == ledger.PROCESSED:
+                    if delete_now:
+                        await delete_queue.put(email)
+                elif status is None:
+                    await parse_queue.put(email)
+
+    async def parse():
+        while True:
+            email = await parse_queue.get()
+            if email is None:
+                break
+            rule = DC.match_email(email)
+            if rule is None:
+                metrics.inc('emails_skipped')
+                continue
+            executor = thread_pool if process_pool is None or rule[1] == DC.ATTACHMENT else process_pool
+            with metrics.span('parse_email'):
+                try:
+                    transaction, error, seconds = await loop.run_in_executor(executor, DC.parse_email, email)
+                except BrokenProcessPool:
+                    # A parse process died, the email is tried again on a new pool
+                    DC.discard_process_pool(executor)
+                    progress['complete'] = False
+                    continue
+            DC.record_parse(email, error, seconds)
+            count_parse_result(error)
+            if error is not None:
+                # Has to be tried again, the delta link can't move past it
+                progress['complete'] = False
+                continue
+            if type(transaction) == dict:
+                transaction = [transaction]
+            await notify_queue.put((email, transaction))
+
+    async def notify():
+        while True:
+            item = await notify_queue.get()
+            if item is None:
+                break
+            email, transactions = item
+            futures = notify_transactions(email, transactions)
+            if all([await asyncio.wrap_future(future) for future in futures]):
+                ledger.LEDGER.mark_message(email, folder_id, ledger.PROCESSED)
+                if delete_now:
+                    await delete_queue.put(email)
+            else:
+                progress['complete'] = False
+
+    async def delete():
+        while True:
+            email = await delete_queue.get()
+            if email is None:
+                break
+            # Take whatever else is already waiting, up to a $batch request
+            emails = [email]
+            stop = False
+            while len(emails) < GRAPH_BATCH_SIZE and not delete_queue.empty():
+                email = delete_queue.get_nowait()
+                if email is None:
+                    stop = True
+                    break
+                emails.append(email)
+            deleted = await loop.run_in_executor(thread_pool, delete_emails_in_folder, emails, token, folder_id)
+            for deleted_email in deleted:
+                ledger.LEDGER.mark_message(deleted_email, folder_id, ledger.DELETED)
+            if len(deleted) < len(emails):
+                progress['complete'] = False
+            if stop:
+                break
+
+    async def run_stage(workers, next_queue, next_workers):
+        # When every worker of a stage is done, tell the next stage's workers to stop
+        await asyncio.gather(*workers)
+        for _ in range(next_workers):
+            await next_queue.put(None)
+
+    try:
+        parsers = [asyncio.ensure_future(parse()) for _ in range(PIPELINE_PARSE_WORKERS)]
+        notifiers = [asyncio.ensure_future(notify()) for _ in range(PIPELINE_NOTIFY_WORKERS)]
+        deleters = [asyncio.ensure_future(delete()) for _ in range(PIPELINE_DELETE_WORKERS)]
+        await asyncio.gather(
+            run_stage([fetch()], parse_queue, PIPELINE_PARSE_WORKERS),
+            run_stage(parsers, notify_queue, PIPELINE_NOTIFY_WORKERS),
+            run_stage(notifiers, delete_queue, PIPELINE_DELETE_WORKERS),
+            *deleters
+        )
+        if not delete_now:
+            await loop.run_in_executor(thread_pool, delete_pending_emails, token, folder_id)
+    finally:
+        thread_pool.shutdown()
+
+    # Next sync only needs what arrives after this run,
+    # unless some email couldn't be parsed, sent or deleted and has to be seen again
+    if progress['delta_link'] is not None and progress['complete']:
+        save_delta_link(folder_id, progress['delta_link'])
+
+
+def folder_lock(folder_id):
+    '''
+    Returns the lock of a folder, held by the job processing it
+    '''
+    with FOLDER_LOCKS_LOCK:
+        return FOLDER_LOCKS.setdefault(folder_id, threading.Lock())
 
-    # Email handling
-    token = get_token()
-    emails = gather_emails(token, os.getenv('ADO_FOLDER_ID'))
-
-    # Extract link from emails
-    links = []
-    for email in emails:
-        soup = BeautifulSoup(email['body']['content'], 'html.parser')
-        link = soup.find('a', string=re.compile('Boleto'))['href']
-        links.append((link, email['id']))
-
-    # Extract info from pdfs
-    tickets_info = []
-    for link, email_id in links:
-        try:
-            tickets_info.extend(ADO.get_info_from_pdf_link(link, email_id))
-        except PdfReadError:
-            print("Unable to read ticket. Ticket is probably cancelled or changed")
-
-    # Separate into main and other tickets,
-    # and only grab tickets from last month
-    main_tickets = []
-    other_tickets = []
-    for ticket in tickets_info:
-
-        # Get datetime of ticket
-        # Get abbreviation from ticket
-        ticket_month_str = ticket['date'].split(' ')[1]
-        # Get equivalent int from dictionary and replace it in date string
-        ticket_date_str = ticket['date'].replace(ticket_month_str, MONTHS[ticket_month_str])
-        # strptime and make it timezone aware
-        ticket_date = datetime.datetime.strptime(ticket_date_str, '%d %m %y')
-        ticket_date = MEXICO_CITY_TIMEZONE.localize(ticket_date)
-
-        # Get last month datetime aware range
-        # Get current date
-        current_date = datetime.datetime.now(MEXICO_CITY_TIMEZONE)
-        # From current date, go back to first instant of the current month
-        first_instant_of_current_month = current_date.replace(day=1,
-                                                              hour=0,
-                                                              minute=0,
-                                                              second=0,
-                                                              microsecond=0
-                                                              )
-        # From first instant of current month,
-        # substract a microsecond to get the last instant of previous month
-        last_instant_of_previous_month = first_instant_of_current_month - timedelta(microseconds=1)
-        # From the last instant of that previous month,
-        # go to the first instant of that previous month
-        first_instant_of_previous_month = last_instant_of_previous_month.replace(day=1,
-                                                                                 hour=0,
-                                                                                 minute=0,
-                                                                                 second=0,
-                                                                                 microsecond=0
-                                                                                 )
-
-        # Check if ticket is in range
-        if not first_instant_of_previous_month < ticket_date < last_instant_of_previous_month:
-            continue
 
-        # Get word distance to main passanger
-        dist = nltk.edit_distance(ticket['name'], 'RAFAEL YOBAIN LUNA GOMEZ')
-        if dist <= 5:
-            main_tickets.append(ticket)
-        else:
-            other_tickets.append(ticket)
+def run_debit_and_credit(account=config.DEFAULT_ACCOUNT, folder_id=None):
+    '''
+    Runs the D&C automation on a folder, waiting for any run already in progress on it
+    '''
+    folder_id = folder_id or os.getenv('DEBIT_AND_CREDIT_FOLDER_ID')
+    with folder_lock(folder_id):
+        debit_and_credit_automation(account, folder_id)
 
-    pp(main_tickets)
-    pp(other_tickets)
 
-    # Facturar
-    if len(main_tickets) > 0:
-        pdf_link = ADO.facturar_lote(main_tickets)
+def poll_debit_and_credit(account=config.DEFAULT_ACCOUNT, folder_id=None):
+    '''
+    Runs the D&C automation on a folder every minute,
+    unless change notifications for it are active
+    '''
+    folder_id = folder_id or os.getenv('DEBIT_AND_CREDIT_FOLDER_ID')
+    if LISTENER is not None and LISTENER.folder_id == folder_id and LISTENER.is_active():
+        return
+    run_debit_and_credit(account, folder_id)
+
+
+def renew_subscription():
+    '''
+    Keeps the change notifications subscription alive, recreating it if it lapsed
+    '''
+    if LISTENER is not None:
+        LISTENER.renew()
 
-        # Send Telegram message
-        text = "*Facturación detectada ADO*\n\n"
-        # Check if facturación was successful
-        if pdf_link is None:
-            text += "Facturación fallida"
-        else:
-            text += f"*PDF Link*: {pdf_link}"
-        # Send message
-        send_telegram_message(text)
 
-    if len(other_tickets) > 0:
-        pdf_link = ADO.facturar_lote(other_tickets)
+@metrics.timed('job', job='collect_ado')
+def collect_ado(account=config.DEFAULT_ACCOUNT, folder_id=None):
+    '''
+    Picks up ADO emails not collected yet from an account's folder (by default the
+    one in ADO_FOLDER_ID), reads the tickets in their pdfs once, and stores them
+    in the ledger's ticket index by month.
+    Returns whether every email was collected
+    '''
+    folder_id = folder_id or os.getenv('ADO_FOLDER_ID')
+    with folder_lock(folder_id):
+        print("Collecting ADO tickets...")
+        token = get_token(account)
+        complete = True
+        delta_link = None
+        # The delta link is kept in the ledger along with the ticket index, so a
+        # new (empty) ledger starts from scratch instead of skipping every email
+        for page in iter_folder_pages(token, folder_id, ledger.LEDGER.delta_link):
+            delta_link = page.get('@odata.deltaLink', delta_link)
+
+            links = []
+            for email in page['value']:
+                if ledger.LEDGER.is_collected(email['id']):
+                    continue
+                link = DC.find_boleto_link(email['body']['content'])
+                if link is None:
+                    # No ticket link, nothing to collect from it
+                    print(f"No ticket in '{email['subject']}'")
+                    ledger.LEDGER.add_tickets(email['id'], folder_id, [], [])
+                    continue
+                links.append((link, email['id']))
+
+            for email_id, tickets, error in ADO.read_tickets(links):
+                # Unreadable for now, next run tries again
+                if tickets is None:
+                    complete = False
+                    # Pages the pattern can't read won't fix themselves, they're reported once
+                    if isinstance(error, ADO.UnreadPagesError) and not ledger.LEDGER.is_notified(email_id, UNREAD_PAGES):
+                        send_telegram_message(f"*Boleto ADO sin leer*\n\n{error.link}: {error}")
+                        ledger.LEDGER.mark_notified(email_id, UNREAD_PAGES)
+                    continue
+                ledger.LEDGER.add_tickets(email_id, folder_id, tickets, ADO.ticket_months(tickets))
+
+        # Next sync only needs what arrives after this run
+        if delta_link is not None and complete:
+            ledger.LEDGER.save_delta_link(folder_id, delta_link)
+        print("Collecting ADO tickets Done\n")
+        return complete
+
+
+@metrics.timed('job', job='facturar_ado')
+def facturar_ado(first_month=None, last_month=None, account=config.DEFAULT_ACCOUNT, folder_id=None):
+    '''
+    Invoices the ADO tickets collected from an account's folder (by default the one
+    in ADO_FOLDER_ID), after collecting any email that arrived since the last collection.
+    Bills tickets from first_month to last_month ('YYYY-MM', also read from
+    ADO_BILLING_FROM and ADO_BILLING_TO), or from last month if not given
+    '''
+    print("Facturando ADO...")
+    folder_id = folder_id or os.getenv('ADO_FOLDER_ID')
+    first_month = first_month or os.getenv('ADO_BILLING_FROM')
+    last_month = last_month or os.getenv('ADO_BILLING_TO')
+
+    # Only emails that arrived since the last collection are read here
+    collect_ado(account, folder_id)
+
+    # Only grab tickets within the billing window, last month by default
+    start, end = ADO.billing_window(datetime.datetime.now(MEXICO_CITY_TIMEZONE), first_month, last_month)
+    print(f"Billing tickets from {start} to {end}")
+    month_tickets = ledger.LEDGER.tickets_between(folder_id, start.strftime('%Y-%m'), end.strftime('%Y-%m'))
+
+    # Claim the folios before anything is sent to ADO, so another run never takes them.
+    # Folios already invoiced are skipped, and so are those being invoiced, by another
+    # run or by one that stopped (those may have gone through and have to be checked by hand)
+    pending_tickets = ledger.LEDGER.claim_folios(month_tickets)
+    claimed_folios = {ticket['folio'] for ticket in pending_tickets}
+    for ticket in month_tickets:
+        if ticket['folio'] not in claimed_folios and ledger.LEDGER.folio_status(ticket['folio']) == ledger.INVOICING:
+            print(f"Folio {ticket['folio']} is being invoiced by another run or one that stopped, check it by hand")
+
+    # Separate tickets by passenger, each passenger is a lot
+    lots = ADO.group_by_passenger(pending_tickets)
+    for lot in lots:
+        pp(lot)
+
+    # Facturar every lot at the same time
+    for pdf_link, _ in ADO.facturar_lotes(lots):
 
         # Send Telegram message
         text = "*Facturación detectada ADO*\n\n"
@@ -323,9 +749,97 @@ def facturar_ado():
         # Send message
         send_telegram_message(text)
 
-    # Get info fro
     print("Facturando ADO Done\n")
 
+
+def print_metrics():
+    '''
+    Prints the metrics summary and the profile of every D&C parser
+    '''
+    metrics.summary()
+    DC.print_parser_stats()
+
+
+def create_scheduler(units=None, process_type=None):
+    '''
+    Creates the scheduler with a job per configured unit, plus the maintenance jobs.
+    D&C units run on a pool with a thread per folder, ADO units on their own pool,
+    and maintenance on the default one, so no job waits for another kind of job.
+    With a process_type (WEB or CLOCK) only the jobs of that process are added
+    '''
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.executors.pool import ThreadPoolExecutor as JobExecutor
+
+    units = config.load_units() if units is None else units
+    dc_units = [unit for unit in units if unit['job'] == config.DEBIT_AND_CREDIT]
+    ado_units = [unit for unit in units if unit['job'] == config.FACTURAR_ADO]
+    # D&C goes to web when notifications are enabled and to clock when they're not,
+    # so it never runs in both
+    if process_type is not None and (process_type == WEB) != bool(NOTIFICATION_URL):
+        dc_units = []
+    if process_type == WEB:
+        ado_units = []
+
+    scheduler = BlockingScheduler(
+        executors={
+            'default': JobExecutor(2),
+            'mail': JobExecutor(max(1, len(dc_units))),
+            # Collection and invoicing of each folder
+            'invoicing': JobExecutor(max(1, 2 * len(ado_units)))
+        },
+        # A unit never runs twice at once, and missed runs are merged into one
+        job_defaults={'max_instances': 1, 'coalesce': True}
+    )
+
+    now = datetime.datetime.now(MEXICO_CITY_TIMEZONE)
+    for index, unit in enumerate(dc_units):
+        minutes = unit.get('minutes', 1)
+        # Folders are spread over the interval instead of all polling at once
+        start = now + datetime.timedelta(seconds=60 * minutes * (index + 1) / len(dc_units))
+        scheduler.add_job(poll_debit_and_credit, 'interval', minutes=minutes, start_date=start,
+                          kwargs={'account': unit['account'], 'folder_id': unit['folder_id']},
+                          id=config.unit_id(unit), executor='mail', misfire_grace_time=DC_MISFIRE_GRACE_TIME)
+    for unit in ado_units:
+        scheduler.add_job(collect_ado, 'interval', minutes=ADO_COLLECT_MINUTES,
+                          kwargs={'account': unit['account'], 'folder_id': unit['folder_id']},
+                          id=f'collect_ado:{unit["account"]}:{unit["folder_id"]}', executor='invoicing',
+                          misfire_grace_time=ADO_MISFIRE_GRACE_TIME)
+        scheduler.add_job(facturar_ado, 'cron', day=1, hour=9, minute=30, second=0, timezone=MEXICO_CITY_TIMEZONE,
+                          kwargs={'account': unit['account'], 'folder_id': unit['folder_id']},
+                          id=config.unit_id(unit), executor='invoicing', misfire_grace_time=ADO_MISFIRE_GRACE_TIME)
+
+    if process_type != CLOCK:
+        scheduler.add_job(renew_subscription, 'interval', hours=1, id='renew_subscription')
+    scheduler.add_job(print_metrics, 'interval', minutes=METRICS_SUMMARY_MINUTES, id='metrics_summary')
+    metrics.listen(scheduler)
+    return scheduler
+
+
 if __name__ == "__main__":
-    initialize_firebase()
+    # Process type from the Procfile, none runs everything
+    PROCESS_TYPE = sys.argv[1] if len(sys.argv) > 1 else None
+    if PROCESS_TYPE not in (None, WEB, CLOCK):
+        sys.exit(f"Unknown process type '{PROCESS_TYPE}', expected {WEB} or {CLOCK}")
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+    # Notifications are received for the D&C folder of the environment,
+    # every other configured folder is polled
+    if NOTIFICATION_URL and PROCESS_TYPE != CLOCK:
+        import notifications
+
+        LISTENER = notifications.NotificationListener(
+            run_debit_and_credit,
+            get_token,
+            os.getenv('DEBIT_AND_CREDIT_FOLDER_ID'),
+            NOTIFICATION_URL,
+            int(os.getenv('PORT', '8000')),
+            store=STATE
+        )
+        LISTENER.start()
+    elif PROCESS_TYPE == WEB:
+        # Heroku restarts a web process that doesn't bind $PORT, with nothing
+        # to listen for it serves the metrics there
+        print("No GRAPH_NOTIFICATION_URL, D&C runs in the clock process")
+        metrics.serve(int(os.getenv('PORT', '8000')))
+    SCHED = create_scheduler(process_type=PROCESS_TYPE)
     SCHED.start()
@@ -0,0 +1,175 @@
+'''
+Module with the job instrumentation.
+Keeps timing spans and counters in memory, and exposes them through a
+Prometheus style endpoint or a printed summary
+'''
+
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import http_client
+
+
+PREFIX = 'personal_automation'
+
+# {(name, labels): {'count', 'sum', 'max'}}
+SPANS = {}
+# {(name, labels): value}
+COUNTERS = {}
+LOCK = threading.Lock()
+
+
+def label_key(labels):
+    '''
+    Turns labels into a hashable, ordered tuple
+    '''
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    '''
+    Records a duration for a span
+    '''
+    with LOCK:
+        span_stats = SPANS.setdefault((name, label_key(labels)), {'count': 0, 'sum': 0.0, 'max': 0.0})
+        span_stats['count'] += 1
+        span_stats['sum'] += seconds
+        span_stats['max'] = max(span_stats['max'], seconds)
+
+
+@contextmanager
+def span(name, **labels):
+    '''
+    Times the code inside the with block, errors included
+    '''
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def timed(name, **labels):
+    '''
+    Decorator that times every call of a function as a span
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(name, value=1, **labels):
+    '''
+    Increments a counter
+    '''
+    with LOCK:
+        key = (name, label_key(labels))
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def format_labels(labels):
+    '''
+    Formats labels the way Prometheus expects them
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render():
+    '''
+    Returns every metric in Prometheus text format
+    '''
+    lines = []
+    with LOCK:
+        spans = {key: dict(value) for key, value in SPANS.items()}
+        counters = dict(COUNTERS)
+
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f'{PREFIX}_{name}_total{format_labels(labels)} {value}')
+    for (name, labels), span_stats in sorted(spans.items()):
+        for stat in ('count', 'sum', 'max'):
+            lines.append(f'{PREFIX}_{name}_seconds_{stat}{format_labels(labels)} {span_stats[stat]}')
+    for host, host_stats in sorted(http_client.stats().items()):
+        for stat, value in host_stats.items():
+            lines.append(f'{PREFIX}_http_{stat}{format_labels((("host", host),))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    '''
+    Prints a summary of every span and counter
+    '''
+    with LOCK:
+        spans = {key: dict(value) for key, value in SPANS.items()}
+        counters = dict(COUNTERS)
+
+    print('Metrics summary:')
+    for (name, labels), value in sorted(counters.items()):
+        print(f'\t{name}{format_labels(labels)}: {value}')
+    for (name, labels), span_stats in sorted(spans.items()):
+        average = span_stats['sum'] / span_stats['count']
+        print(f'\t{name}{format_labels(labels)}: {span_stats["count"]} runs, '
+              f'avg {average:.3f}s, max {span_stats["max"]:.3f}s')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the metrics at /metrics
+    '''
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes arrive often, don't print every request
+        pass
+
+
+def serve(port):
+    '''
+    Starts the metrics endpoint on a background thread
+    '''
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def listen(scheduler):
+    '''
+    Records scheduler job events: executions, errors, missed runs and
+    runs skipped because the previous one was still going
+    '''
+    from apscheduler.events import (
+        EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+    )
+
+    names = {
+        EVENT_JOB_EXECUTED: 'job_executed',
+        EVENT_JOB_ERROR: 'job_error',
+        EVENT_JOB_MISSED: 'job_missed',
+        EVENT_JOB_MAX_INSTANCES: 'job_max_instances'
+    }
+
+    def record(event):
+        inc(names[event.code], job=event.job_id)
+        if event.code != EVENT_JOB_EXECUTED:
+            print(f'Job {event.job_id}: {names[event.code]}')
+
+    scheduler.add_listener(record, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
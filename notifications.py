@@ -0,0 +1,203 @@
+'''
+Module for receiving Microsoft Graph change notifications.
+Runs a small webhook receiver that feeds an in-process queue,
+keeps a subscription to a mail folder alive, and drains the queue
+by calling the existing processing code
+'''
+
+import os
+import json
+import queue
+import secrets
+import datetime
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import http_client
+
+
+MS_GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+# Mail subscriptions last at most a few days, they're renewed well before that
+SUBSCRIPTION_MINUTES = 4230
+RENEW_BEFORE = datetime.timedelta(hours=24)
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    '''
+    Webhook endpoint for Graph.
+    Answers subscription validation requests and queues notifications
+    '''
+
+    # Set by NotificationListener
+    listener = None
+
+    def do_POST(self):
+        query = parse_qs(urlsplit(self.path).query)
+
+        # Graph validates the endpoint by sending a token that must be echoed back
+        if 'validationToken' in query:
+            body = query['validationToken'][0].encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            notifications = json.loads(self.rfile.read(length))['value']
+        except (ValueError, KeyError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        # Answer right away, processing happens on the queue
+        self.send_response(202)
+        self.end_headers()
+        for notification in notifications:
+            self.listener.receive(notification)
+
+    def log_message(self, format, *args):
+        # Notifications arrive often, don't print every request
+        pass
+
+
+class NotificationListener:
+    '''
+    Listens for new emails in a folder through Graph change notifications.
+    Every batch of notifications calls handler() once. While the subscription
+    is not active, is_active() returns False so callers can fall back to polling.
+    With a store (see state.StateStore) the client state and subscription id are
+    kept at subscriptions/{folder_id}, so a restart keeps accepting and renewing
+    the subscription it made before
+    '''
+
+    def __init__(self, handler, get_token, folder_id, notification_url, port, store=None, graph_url=MS_GRAPH_URL):
+        self.handler = handler
+        self.get_token = get_token
+        self.folder_id = folder_id
+        self.notification_url = notification_url
+        self.port = port
+        self.graph_url = graph_url
+        self.store = store
+        self.store_key = f'subscriptions/{folder_id}'
+        saved = (store.get(self.store_key) if store is not None else None) or {}
+        self.client_state = os.getenv('GRAPH_CLIENT_STATE') or saved.get('client_state') or secrets.token_hex(16)
+        self.events = queue.Queue()
+        self.subscription_id = saved.get('id')
+        self.expires_at = None
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        '''
+        Starts the webhook receiver and the queue drainer, then subscribes
+        '''
+        handler_class = type('BoundNotificationHandler', (NotificationHandler,), {'listener': self})
+        self.server = ThreadingHTTPServer(('', self.port), handler_class)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self.drain, daemon=True).start()
+        self.renew()
+        # Process whatever is already in the folder
+        self.events.put({})
+
+    def stop(self):
+        '''
+        Stops the webhook receiver
+        '''
+        if self.server is not None:
+            self.server.shutdown()
+
+    def receive(self, notification):
+        '''
+        Queues a notification, ignoring those not meant for this listener
+        '''
+        if notification.get('clientState') != self.client_state:
+            print('Ignoring notification with unknown client state')
+            return
+
+        # Subscription was removed by Graph, polling takes over until it's created again
+        if notification.get('lifecycleEvent') == 'subscriptionRemoved':
+            print('Subscription removed, falling back to polling')
+            with self.lock:
+                self.subscription_id = None
+                self.expires_at = None
+            return
+
+        # Anything else (new message, missed notifications) means the folder must be synced
+        self.events.put(notification)
+
+    def drain(self):
+        '''
+        Waits for notifications, and runs the handler once per batch of them
+        '''
+        while True:
+            self.events.get()
+            # Several emails arriving together only need one run
+            while not self.events.empty():
+                self.events.get_nowait()
+            try:
+                self.handler()
+            except Exception as error:
+                print(f'Error handling notifications: {error}')
+
+    def is_active(self):
+        '''
+        Returns whether there's a subscription that hasn't lapsed
+        '''
+        with self.lock:
+            return self.expires_at is not None and datetime.datetime.now(datetime.timezone.utc) < self.expires_at
+
+    def renew(self):
+        '''
+        Renews the subscription when it's close to expire, or creates it if there's none.
+        On failure the subscription is left inactive, so polling takes over
+        '''
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self.lock:
+            subscription_id = self.subscription_id
+            if self.expires_at is not None and now < self.expires_at - RENEW_BEFORE:
+                return
+
+        headers = {
+            'Authorization': self.get_token()
+        }
+        expiration = now + datetime.timedelta(minutes=SUBSCRIPTION_MINUTES)
+        expiration_string = expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+
+        response = None
+        if subscription_id is not None:
+            response = http_client.request(
+                'PATCH',
+                f'{self.graph_url}/subscriptions/{subscription_id}',
+                headers=headers,
+                json={'expirationDateTime': expiration_string}
+            )
+            # Can't be renewed, don't leave it sending notifications next to the new one
+            if not response.ok and response.status_code != 404:
+                http_client.request('DELETE', f'{self.graph_url}/subscriptions/{subscription_id}', headers=headers)
+        # No subscription yet, or it's gone, create a new one
+        if response is None or not response.ok:
+            response = http_client.post(f'{self.graph_url}/subscriptions', headers=headers, json={
+                'changeType': 'created',
+                'notificationUrl': self.notification_url,
+                'lifecycleNotificationUrl': self.notification_url,
+                'resource': f"me/mailFolders('{self.folder_id}')/messages",
+                'expirationDateTime': expiration_string,
+                'clientState': self.client_state
+            })
+
+        with self.lock:
+            if response.ok:
+                self.subscription_id = response.json()['id']
+                self.expires_at = expiration
+                print(f'Subscription {self.subscription_id} active until {expiration_string}')
+                if self.store is not None and self.subscription_id != subscription_id:
+                    self.store.set(self.store_key, {'id': self.subscription_id, 'client_state': self.client_state})
+            else:
+                print(f'Could not subscribe to notifications ({response.status_code}), polling instead')
+                self.subscription_id = None
+                self.expires_at = None
@@ -0,0 +1,201 @@
+'''
+Module with the on-disk cache of downloaded PDFs.
+Stores the raw bytes and the text of every page keyed by content hash,
+and maps each URL to its hash, so a PDF is only downloaded and parsed once
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import metrics
+import http_client
+
+
+CACHE_DIR = os.getenv('PDF_CACHE_DIR', '.pdf_cache')
+# Least recently used PDFs are evicted once the cache is bigger than this
+MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+# Downloads are streamed in chunks, and only spill to disk when bigger than SPOOL_BYTES
+CHUNK_BYTES = 64 * 1024
+SPOOL_BYTES = 4 * 1024 * 1024
+
+INDEX_PATH = os.path.join(CACHE_DIR, 'index.json')
+LOCK = threading.Lock()
+
+
+def write_atomic(path, data):
+    '''
+    Writes bytes or the contents of a file object to a file through a temporary file,
+    so readers never see half of it
+    '''
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as tmp_file:
+        if isinstance(data, bytes):
+            tmp_file.write(data)
+        else:
+            data.seek(0)
+            shutil.copyfileobj(data, tmp_file)
+    os.replace(tmp_path, path)
+
+
+def load_index():
+    '''
+    Loads the index of cached PDFs:
+    {'urls': {url: hash}, 'entries': {hash: {'size': bytes, 'last_used': timestamp}}}
+    '''
+    try:
+        with open(INDEX_PATH) as index_file:
+            return json.load(index_file)
+    except (FileNotFoundError, ValueError):
+        return {'urls': {}, 'entries': {}}
+
+
+def save_index(index):
+    '''
+    Stores the index of cached PDFs
+    '''
+    write_atomic(INDEX_PATH, json.dumps(index).encode())
+
+
+def record_path(content_hash):
+    '''
+    Path of the json with the pages text and extracted fields of a PDF
+    '''
+    return os.path.join(CACHE_DIR, f'{content_hash}.json')
+
+
+def pdf_path(content_hash):
+    '''
+    Path of the raw bytes of a PDF
+    '''
+    return os.path.join(CACHE_DIR, f'{content_hash}.pdf')
+
+
+def load_record(content_hash):
+    '''
+    Loads the pages text and extracted fields of a cached PDF
+    '''
+    with open(record_path(content_hash)) as record_file:
+        return json.load(record_file)
+
+
+def save_record(content_hash, record):
+    '''
+    Stores the pages text and extracted fields of a cached PDF
+    '''
+    write_atomic(record_path(content_hash), json.dumps(record).encode())
+
+
+def evict(index, keep):
+    '''
+    Removes least recently used PDFs until the cache fits in MAX_BYTES,
+    never removing the one with hash keep
+    '''
+    entries = index['entries']
+    total = sum(entry['size'] for entry in entries.values())
+    for content_hash in sorted(entries, key=lambda h: entries[h]['last_used']):
+        if total <= MAX_BYTES:
+            break
+        if content_hash == keep:
+            continue
+        total -= entries.pop(content_hash)['size']
+        for path in (pdf_path(content_hash), record_path(content_hash)):
+            if os.path.exists(path):
+                os.remove(path)
+    index['urls'] = {url: h for url, h in index['urls'].items() if h in entries}
+
+
+def download(url):
+    '''
+    Streams the PDF at url into a spooled temporary file, hashing it on the way.
+    Returns the file and the hash of its content. Error statuses raise HTTPError,
+    an error page is never read as the PDF
+    '''
+    pdf_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    digest = hashlib.sha256()
+    with http_client.get(url, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(CHUNK_BYTES):
+            digest.update(chunk)
+            pdf_file.write(chunk)
+    metrics.inc('bytes_downloaded', pdf_file.tell(), source='pdf')
+    pdf_file.seek(0)
+    return pdf_file, digest.hexdigest()
+
+
+def read_pages(pdf_file):
+    '''
+    Extracts the text of every page of a PDF file
+    '''
+    import PyPDF2
+
+    reader = PyPDF2.PdfFileReader(pdf_file)
+    return [reader.getPage(page_number).extractText() for page_number in range(reader.getNumPages())]
+
+
+def get_hash(url):
+    '''
+    Returns the content hash of the PDF at url, downloading and parsing it
+    only if it's not cached yet
+    '''
+    with LOCK:
+        index = load_index()
+        content_hash = index['urls'].get(url)
+        if content_hash is not None and os.path.exists(record_path(content_hash)):
+            index['entries'][content_hash]['last_used'] = time.time()
+            save_index(index)
+            return content_hash
+
+    pdf_file, content_hash = download(url)
+    with pdf_file:
+        # Same PDF may already be cached under another url,
+        # otherwise parse it outside the lock. Parse errors propagate and nothing gets cached
+        pages = None
+        if not os.path.exists(record_path(content_hash)):
+            pages = read_pages(pdf_file)
+
+        with LOCK:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            index = load_index()
+            if pages is not None:
+                write_atomic(pdf_path(content_hash), pdf_file)
+                save_record(content_hash, {'pages': pages, 'fields': {}})
+            index['urls'][url] = content_hash
+            index['entries'][content_hash] = {
+                'size': os.path.getsize(pdf_path(content_hash)) + os.path.getsize(record_path(content_hash)),
+                'last_used': time.time()
+            }
+            evict(index, keep=content_hash)
+            save_index(index)
+    return content_hash
+
+
+def get_pages(url):
+    '''
+    Returns the text of every page of the PDF at url
+    '''
+    return load_record(get_hash(url))['pages']
+
+
+def extract(url, name, extractor):
+    '''
+    Returns the fields extracted with extractor(pages) from the PDF at url.
+    Results are cached under name, so extractor only runs once per PDF
+    '''
+    content_hash = get_hash(url)
+    with LOCK:
+        record = load_record(content_hash)
+        if name in record['fields']:
+            return record['fields'][name]
+
+    fields = extractor(record['pages'])
+
+    with LOCK:
+        record = load_record(content_hash)
+        record['fields'][name] = fields
+        save_record(content_hash, record)
+    return fields
@@ -0,0 +1,139 @@
+'''
+Module with the local store of the state kept in Firebase.
+Values (refresh token, delta links, any other sync cursor) are cached in a
+local SQLite file and read from there. Writes go to the local file right away
+and are sent to Firebase by a background thread. Every value has a version
+stored next to it in Firebase, so a value changed elsewhere is read again
+'''
+
+import os
+import json
+import time
+import uuid
+import atexit
+import sqlite3
+import threading
+
+
+STATE_PATH = os.getenv('STATE_PATH', 'state.sqlite3')
+# Local values are trusted for this long before checking their version in Firebase
+CHECK_SECONDS = int(os.getenv('STATE_CHECK_SECONDS', '300'))
+# Wait before retrying a failed write to Firebase
+RETRY_SECONDS = 30
+
+# Firebase path where the version of every value is kept
+VERSIONS = 'state_versions'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    version TEXT,
+    synced INTEGER NOT NULL,
+    checked_at REAL NOT NULL
+);
+'''
+
+
+class StateStore:
+    '''
+    Local write-through cache of Firebase values, by Firebase path.
+    remote is called to get Firebase's db module (or anything with the same
+    reference(path).get() / update() interface), only when it's needed
+    '''
+
+    def __init__(self, remote, path=STATE_PATH):
+        self.remote = remote
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+        self.pending = threading.Event()
+        self.worker = None
+        atexit.register(self.flush)
+
+    def execute(self, query, params=()):
+        '''
+        Runs a query in its own transaction and returns all its rows
+        '''
+        with self.lock, self.connection:
+            return self.connection.execute(query, params).fetchall()
+
+    def store(self, key, value, version, synced):
+        '''
+        Writes a value to the local file
+        '''
+        self.execute(
+            'INSERT OR REPLACE INTO state (key, value, version, synced, checked_at) VALUES (?, ?, ?, ?, ?)',
+            (key, json.dumps(value), version, int(synced), time.time())
+        )
+
+    def get(self, key):
+        '''
+        Returns the value at key. The local copy is used if it's not synced yet,
+        was checked recently, or its version is still the one in Firebase
+        '''
+        rows = self.execute('SELECT value, version, synced, checked_at FROM state WHERE key = ?', (key,))
+        if rows:
+            value, version, synced, checked_at = rows[0]
+            if not synced or time.time() - checked_at < CHECK_SECONDS:
+                return json.loads(value)
+
+        db = self.remote()
+        remote_version = db.reference(f'{VERSIONS}/{key}').get()
+        if rows and remote_version is not None and remote_version == version:
+            self.execute('UPDATE state SET checked_at = ? WHERE key = ?', (time.time(), key))
+            return json.loads(value)
+
+        # Changed elsewhere, or never read before
+        value = db.reference(key).get()
+        self.store(key, value, remote_version, synced=True)
+        return value
+
+    def set(self, key, value):
+        '''
+        Sets the value at key locally, and queues it to be written to Firebase
+        '''
+        self.store(key, value, uuid.uuid4().hex, synced=False)
+        self.pending.set()
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, daemon=True)
+                self.worker.start()
+
+    def invalidate(self, key):
+        '''
+        Makes the next get of key check Firebase, unless it has a local write pending
+        '''
+        self.execute('UPDATE state SET checked_at = 0 WHERE key = ? AND synced = 1', (key,))
+
+    def flush(self):
+        '''
+        Writes every local value not synced yet to Firebase, each one with its version.
+        Returns whether all of them were written
+        '''
+        rows = self.execute('SELECT key, value, version FROM state WHERE synced = 0')
+        if not rows:
+            return True
+        try:
+            db = self.remote()
+            for key, value, version in rows:
+                # Value and version are updated together
+                db.reference('/').update({key: json.loads(value), f'{VERSIONS}/{key}': version})
+                # Only mark it synced if it didn't change while being written
+                self.execute('UPDATE state SET synced = 1 WHERE key = ? AND version = ?', (key, version))
+        except Exception as error:
+            print(f'Could not write state to firebase: {error}')
+            return False
+        return True
+
+    def work(self):
+        '''
+        Writes pending values to Firebase in the background, retrying failures
+        '''
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            if not self.flush():
+                time.sleep(RETRY_SECONDS)
+                self.pending.set()
@@ -0,0 +1,145 @@
+'''
+Module for sending telegram messages through an outbound queue.
+Messages are sent in order by a single worker that respects Telegram's
+per chat rate limit, retries with the retry_after Telegram asks for,
+and can merge messages queued together into one
+'''
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import metrics
+import http_client
+
+
+TELEGRAM_URL = "https://api.telegram.org"
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = "\n\n"
+
+# Telegram allows about one message per second to the same chat
+CHAT_INTERVAL = 1.0
+MAX_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+# When coalescing, wait this long for more messages before sending
+COALESCE = os.getenv('TELEGRAM_COALESCE') == '1'
+COALESCE_WAIT = 0.5
+
+
+class TelegramSender:
+    '''
+    Outbound telegram message queue.
+    send() returns a future that resolves to whether the message was delivered
+    '''
+
+    def __init__(self, coalesce=COALESCE, base_url=TELEGRAM_URL):
+        self.coalesce = coalesce
+        self.base_url = base_url
+        self.messages = queue.Queue()
+        # Retries are handled here, following Telegram's retry_after
+        self.client = http_client.HTTPClient(retries=0)
+        self.last_sent = {}
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def send(self, text, chat_id=None, parse_mode="html"):
+        '''
+        Queues a message, by default to myself
+        '''
+        future = Future()
+        chat_id = chat_id or os.getenv("TELEGRAM_CHAT_ID")
+        self.messages.put((chat_id, parse_mode, text, future))
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.work, daemon=True)
+                self.worker.start()
+        return future
+
+    def flush(self):
+        '''
+        Waits until every queued message was handled
+        '''
+        self.messages.join()
+
+    def next_batch(self):
+        '''
+        Takes the next message from the queue, merged with the ones right after it
+        that go to the same chat while they fit in one message
+        '''
+        first = self.messages.get()
+        batch = [first]
+        if not self.coalesce:
+            return batch
+
+        time.sleep(COALESCE_WAIT)
+        length = len(first[2])
+        while True:
+            try:
+                message = self.messages.queue[0]
+            except IndexError:
+                break
+            chat_id, parse_mode, text, _ = message
+            if (chat_id, parse_mode) != first[:2] or length + len(SEPARATOR) + len(text) > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(self.messages.get())
+            length += len(SEPARATOR) + len(text)
+        return batch
+
+    def work(self):
+        '''
+        Sends queued messages in order, forever
+        '''
+        while True:
+            batch = self.next_batch()
+            chat_id, parse_mode = batch[0][:2]
+            text = SEPARATOR.join(message[2] for message in batch)
+            try:
+                delivered = self.deliver(chat_id, parse_mode, text)
+            except Exception as error:
+                print(f'Error sending telegram message: {error}')
+                delivered = False
+            for message in batch:
+                message[3].set_result(delivered)
+                self.messages.task_done()
+
+    def deliver(self, chat_id, parse_mode, text):
+        '''
+        Sends a message, waiting for the chat's rate limit and retrying when
+        Telegram throttles it or fails. Returns whether it was delivered
+        '''
+        url = f'{self.base_url}/bot{os.getenv("TELEGRAM_BOT_TOKEN")}/sendMessage'
+        data = {
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode
+        }
+        for attempt in range(MAX_RETRIES + 1):
+            wait = self.last_sent.get(chat_id, 0) + CHAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            with metrics.span('telegram'):
+                response = self.client.post(url, data=data)
+            self.last_sent[chat_id] = time.monotonic()
+            if response.ok:
+                return True
+
+            if response.status_code == 429:
+                delay = response.json().get('parameters', {}).get('retry_after', RETRY_BACKOFF)
+            elif response.status_code >= 500:
+                delay = RETRY_BACKOFF * 2 ** attempt
+            else:
+                print(f'Telegram rejected message: {response.status_code} {response.text}')
+                return False
+            if attempt < MAX_RETRIES:
+                time.sleep(delay)
+
+        print(f'Could not send telegram message after {MAX_RETRIES + 1} attempts')
+        return False
+
+
+# Default sender shared by all jobs
+SENDER = TelegramSender()
@@ -0,0 +1,22 @@
+'''
+Tests, run with python -m unittest (or pytest) from the repository root.
+Modules read their settings on import, so every file they write goes to
+a scratch directory set here, before any of them is imported
+'''
+
+import os
+import tempfile
+
+
+SCRATCH = tempfile.mkdtemp(prefix='personal-automation-tests-')
+
+for name, path in (
+    ('LEDGER_PATH', 'ledger.sqlite3'),
+    ('STATE_PATH', 'state.sqlite3'),
+    ('PDF_CACHE_DIR', 'pdf_cache'),
+    ('DC_FAILURE_DIR', 'parser_failures')
+):
+    os.environ[name] = os.path.join(SCRATCH, path)
+os.environ.setdefault('TELEGRAM_CHAT_ID', 'tests')
+for name in ('MAIL_SYNC_MODE', 'DC_PIPELINE', 'HTTP_RECORD_DIR', 'HTTP_REPLAY_DIR', 'AUTOMATION_CONFIG'):
+    os.environ.pop(name, None)
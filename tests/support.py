@@ -0,0 +1,153 @@
+'''
+Local stand-ins shared by the tests
+'''
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fixtures
+import ledger
+
+
+class FakeReference:
+    '''
+    Stand-in for a firebase_admin.db reference to path
+    '''
+
+    def __init__(self, db, path):
+        self.db = db
+        self.parts = [part for part in path.split('/') if part]
+
+    def get(self):
+        self.db.reads.append('/'.join(self.parts))
+        node = self.db.data
+        for part in self.parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def update(self, values):
+        if self.db.failures:
+            self.db.failures -= 1
+            raise ConnectionError('firebase is down')
+        self.db.writes.append(dict(values))
+        for path, value in values.items():
+            parts = self.parts + [part for part in path.split('/') if part]
+            node = self.db.data
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = value
+
+
+class FakeDb:
+    '''
+    Stand-in for the firebase_admin.db module, keeping the data in a dict.
+    The next failures updates raise ConnectionError
+    '''
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.reads = []
+        self.writes = []
+        self.failures = 0
+
+    def reference(self, path='/'):
+        return FakeReference(self, path)
+
+
+class FakeServer:
+    '''
+    Local http server answering every request with respond(method, path, headers, body),
+    which returns a (status, body) tuple like the stand-ins of fixtures.Corpus.stub,
+    or (status, body, headers) to send more headers.
+    Requests are kept in requests as (method, path, headers, body, time) tuples
+    '''
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                server.requests.append((self.command, self.path, self.headers, body, time.monotonic()))
+                status, content, *extra = server.respond(self.command, self.path, self.headers, body)
+                if isinstance(content, bytes):
+                    content_type = 'application/octet-stream'
+                elif isinstance(content, str):
+                    content_type, content = 'text/html; charset=utf-8', content.encode()
+                else:
+                    content_type, content = 'application/json', json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (extra[0] if extra else {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve(test, respond):
+    '''
+    Starts a FakeServer for the duration of a test
+    '''
+    server = FakeServer(respond).__enter__()
+    test.addCleanup(server.__exit__, None, None, None)
+    return server
+
+
+def email(email_id, sender, subject, html):
+    '''
+    Builds a Graph message with the fields the jobs select
+    '''
+    return {
+        'id': email_id,
+        'subject': subject,
+        'sender': {'emailAddress': {'name': sender}},
+        'body': {'content': html}
+    }
+
+
+class StandInTestCase(unittest.TestCase):
+    '''
+    Test case whose http requests go to stand-ins (see fixtures.Corpus.stub)
+    and that starts from an empty ledger
+    '''
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(dir=os.environ.get('TMPDIR'))
+        self.corpus = fixtures.Corpus(os.path.join(self.scratch, 'corpus'))
+        for name, value in (('CORPUS', self.corpus), ('REPLAYING', True)):
+            patcher = mock.patch.object(fixtures, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ledger, 'LEDGER', ledger.Ledger(os.path.join(self.scratch, 'ledger.sqlite3')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
@@ -0,0 +1,358 @@
+import re
+import random
+import datetime
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import ADO
+import main
+import ledger
+from tests.support import StandInTestCase, serve
+
+
+REGISTER_PAGE = ''.join(
+    f'<input id="{field}" value="{field.lower()}">'
+    for field in ('RRfc', 'IDDatosCliente', 'RName', 'RCalle', 'RColonia', 'RNumExt', 'RNumInt',
+                  'RMunicipio', 'RCodigoPostal', 'RPais', 'REmail')
+) + '<script>\n$(\'#RNac [value="MEX"]\');\n$(\'#REstado [value="CDMX"]\');\n</script>'
+
+
+def ticket(folio):
+    return {'folio': folio, 'seat': '12', 'name': 'RAFAEL YOBAIN LUNA GOMEZ', 'email_id': f'email-{folio}'}
+
+
+def ticket_page(folio, name='RAFAEL YOBAIN LUNA GOMEZ', seat='12', price='450.00', date='05 SEP 26'):
+    '''
+    Text of a ticket PDF page as PyPDF2 extracts it, fields given as None are left out
+    '''
+    lines = [
+        folio,
+        name and f'NOMBRE/NAME{name}ORIGEN',
+        seat and f'ASIENTO/SEAT{seat}FECHA',
+        price and f'$ {price}PRECIO TOTAL',
+        date and f'FECHA/DATEADULTO {date}HORA/HOUR'
+    ]
+    return ''.join(f'{line}\n' for line in lines if line)
+
+
+class ExtractTicketsTest(unittest.TestCase):
+
+    def test_every_field_of_every_page(self):
+        extracted = ADO.extract_tickets([ticket_page('123456789'), ticket_page('987654321', seat='7', price='1,200.00')])
+
+        self.assertEqual(extracted, {'tickets': [
+            {'folio': '123456789', 'name': 'RAFAEL YOBAIN LUNA GOMEZ', 'seat': '12', 'price': '450.00', 'date': '05 SEP 26'},
+            {'folio': '987654321', 'name': 'RAFAEL YOBAIN LUNA GOMEZ', 'seat': '7', 'price': '1,200.00', 'date': '05 SEP 26'}
+        ], 'failures': []})
+
+    def test_pages_with_missing_fields_are_reported(self):
+        pages = [ticket_page('123456789'), ticket_page('987654321', seat=None, price=None), ticket_page(None)]
+
+        extracted = ADO.extract_tickets(pages)
+
+        self.assertEqual([ticket['folio'] for ticket in extracted['tickets']], ['123456789'])
+        self.assertEqual(extracted['failures'], [
+            {'page': 1, 'missing': ['seat', 'price']},
+            {'page': 2, 'missing': ['folio']}
+        ])
+
+    def test_matches_a_search_per_field(self):
+        # The first match of each field wins, and the folio only counts at the start of the page
+        pages = [
+            ticket_page('123456789') + ticket_page('555', name='OTRO PASAJERO', seat='40'),
+            'Boleto 123\n' + ticket_page('987654321')
+        ]
+        searches = {
+            'folio': r'^\d+', 'name': r'/NAME(.+)ORIGEN', 'seat': r'SEAT(.+)FECHA',
+            'price': r'\$ (.+)PRECIO', 'date': r'/DATEADULTO[^\d]+(.+)HORA/HOUR'
+        }
+
+        for text in pages:
+            with self.subTest(text=text):
+                expected = {}
+                for field, pattern in searches.items():
+                    match = re.search(pattern, text)
+                    expected[field] = match and match.group(match.lastindex or 0)
+                missing = [field for field in ADO.TICKET_FIELDS if expected[field] is None]
+
+                extracted = ADO.extract_tickets([text])
+
+                if missing:
+                    self.assertEqual(extracted, {'tickets': [], 'failures': [{'page': 0, 'missing': missing}]})
+                else:
+                    self.assertEqual(extracted, {'tickets': [expected], 'failures': []})
+
+
+def levenshtein(first, second):
+    '''
+    Full Levenshtein distance, without any limit
+    '''
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+class BoundedDistanceTest(unittest.TestCase):
+
+    def test_matches_levenshtein_within_the_limit(self):
+        rng = random.Random(2026)
+        for _ in range(3000):
+            first = ''.join(rng.choice('ABC ') for _ in range(rng.randint(0, 12)))
+            second = ''.join(rng.choice('ABC ') for _ in range(rng.randint(0, 12)))
+            limit = rng.randint(0, 6)
+            distance = levenshtein(first, second)
+            self.assertEqual(
+                ADO.bounded_distance(first, second, limit), distance if distance <= limit else limit + 1,
+                f'{first!r} and {second!r} within {limit}'
+            )
+
+    def test_names(self):
+        self.assertEqual(ADO.bounded_distance('RAFAEL YOBAIN LUNA GOMEZ', 'RAFAEL YOBAIN LUNA GOMEZ', 5), 0)
+        self.assertEqual(ADO.bounded_distance('RAFAEL YOBAIN LUNA GOMES', 'RAFAEL YOBAIN LUNA GOMEZ', 5), 1)
+        self.assertEqual(ADO.bounded_distance('MARIA LOPEZ', 'RAFAEL YOBAIN LUNA GOMEZ', 5), 6)
+
+
+class GroupByPassengerTest(unittest.TestCase):
+
+    def test_tickets_go_to_the_closest_known_passenger(self):
+        passengers = ['RAFAEL YOBAIN LUNA GOMEZ', 'ANA LUNA GOMEZ']
+        tickets = [
+            {'folio': '1', 'name': 'ANA LUNA GOMEZ'},
+            {'folio': '2', 'name': 'RAFAEL YOBAIN LUNA GOMES'},
+            {'folio': '3', 'name': 'MARIA LOPEZ'},
+            {'folio': '4', 'name': 'RAFAEL LUNA GOMEZ'},
+            {'folio': '5', 'name': 'ANA LUNA GOMEZ'}
+        ]
+
+        groups = ADO.group_by_passenger(tickets, passengers, max_distance=5)
+
+        # Known passengers in their order, then everyone else. RAFAEL LUNA GOMEZ is 4 edits
+        # from ANA LUNA GOMEZ and 7 from RAFAEL YOBAIN LUNA GOMEZ, the closest one wins
+        self.assertEqual([[ticket['folio'] for ticket in group] for group in groups], [['2'], ['1', '4', '5'], ['3']])
+
+    def test_empty_groups_are_left_out(self):
+        tickets = [{'folio': '1', 'name': 'MARIA LOPEZ'}]
+
+        self.assertEqual(ADO.group_by_passenger(tickets, ['RAFAEL YOBAIN LUNA GOMEZ'], 5), [tickets])
+        self.assertEqual(ADO.group_by_passenger(tickets, [], 5), [tickets])
+        self.assertEqual(ADO.group_by_passenger([], ['RAFAEL YOBAIN LUNA GOMEZ'], 5), [])
+
+
+class BillingWindowTest(StandInTestCase):
+
+    def test_last_month_by_default(self):
+        self.assertEqual(
+            ADO.billing_window(datetime.datetime(2026, 10, 18)),
+            (datetime.date(2026, 9, 1), datetime.date(2026, 10, 1))
+        )
+
+    def test_january_bills_december_of_the_year_before(self):
+        self.assertEqual(
+            ADO.billing_window(datetime.datetime(2027, 1, 5)),
+            (datetime.date(2026, 12, 1), datetime.date(2027, 1, 1))
+        )
+
+    def test_several_months(self):
+        now = datetime.datetime(2027, 3, 1)
+        self.assertEqual(
+            ADO.billing_window(now, '2026-11', '2027-02'),
+            (datetime.date(2026, 11, 1), datetime.date(2027, 3, 1))
+        )
+        self.assertEqual(
+            ADO.billing_window(now, '2026-11', '2026-12'),
+            (datetime.date(2026, 11, 1), datetime.date(2027, 1, 1))
+        )
+        self.assertEqual(ADO.billing_window(now, '2026-12'), (datetime.date(2026, 12, 1), datetime.date(2027, 1, 1)))
+
+    def test_first_day_of_the_month_is_billed(self):
+        tickets = [
+            dict(ticket(folio), date=date)
+            for folio, date in (('1', '31 AGO 26'), ('2', '01 SEP 26'), ('3', '30 SEP 26'), ('4', '01 OCT 26'))
+        ]
+        ledger.LEDGER.add_tickets('email-1', 'folder-a', tickets, ADO.ticket_months(tickets))
+        start, end = ADO.billing_window(datetime.datetime(2026, 10, 1))
+
+        billed = ledger.LEDGER.tickets_between('folder-a', start.strftime('%Y-%m'), end.strftime('%Y-%m'))
+
+        self.assertEqual([t['folio'] for t in billed], ['2', '3'])
+
+
+class FakeInvoicingSite:
+    '''
+    Stand-in for ADO's invoicing site. Each session gets its own cookie on its first
+    validation, later requests must carry it. Lots with a folio in failing are rejected
+    '''
+
+    def __init__(self, lots, failing=()):
+        self.failing = set(failing)
+        # Every lot's first validation waits for the others, so they must run at the same time
+        self.barrier = threading.Barrier(lots, timeout=5)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        # Folio statuses in the ledger while each lot's invoice request was in flight
+        self.statuses_while_invoicing = {}
+
+    def respond(self, method, path, headers, body):
+        form = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+        cookie = headers.get('Cookie')
+
+        if path == ADO.VALIDATE_PATH:
+            if cookie is None:
+                self.barrier.wait()
+                with self.lock:
+                    cookie = f'session={len(self.sessions)}'
+                    self.sessions[cookie] = []
+                self.sessions[cookie].append(form['folio'])
+                return 200, [{'IDL': cookie}], {'Set-Cookie': f'{cookie}; Path=/'}
+            self.sessions[cookie].append(form['folio'])
+            return 200, [{'IDL': cookie}]
+
+        if path == ADO.REGISTER_PATH:
+            return (200, REGISTER_PAGE) if form['idlote'] == cookie else (403, 'Wrong session')
+
+        if path == ADO.FACTURAR_PATH:
+            if form['idlo'] != cookie:
+                return 403, 'Wrong session'
+            folios = self.sessions[cookie]
+            self.statuses_while_invoicing[tuple(folios)] = [ledger.LEDGER.folio_status(folio) for folio in folios]
+            if self.failing & set(folios):
+                return 500, 'Error'
+            return 200, f'<button id="buttondwPDF" onclick="descargar(\'http://pdf/{folios[0]}.pdf\')">PDF</button>'
+
+        return 404, 'Not found'
+
+
+class FacturarLotesTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Requests go to the fake server, not to stand-ins
+        patcher = mock.patch('fixtures.REPLAYING', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_lots_are_invoiced_concurrently_each_in_its_own_session(self):
+        lots = [[ticket('A1'), ticket('A2')], [ticket('B1')], [ticket('C1'), ticket('C2'), ticket('C3')]]
+        site = FakeInvoicingSite(len(lots), failing={'B1'})
+        server = serve(self, site.respond)
+
+        results = ADO.facturar_lotes(lots, workers=len(lots), base_url=server.url)
+
+        self.assertEqual([pdf_link for pdf_link, _ in results], ['http://pdf/A1.pdf', None, 'http://pdf/C1.pdf'])
+        # Every session only validated the folios of its own lot
+        self.assertEqual(
+            sorted(site.sessions.values()),
+            sorted([ticket['folio'] for ticket in lot] for lot in lots)
+        )
+        for folios, statuses in site.statuses_while_invoicing.items():
+            self.assertEqual(statuses, [ledger.INVOICING] * len(folios))
+        self.assertEqual(len(site.statuses_while_invoicing), len(lots))
+
+        for folio in ('A1', 'A2', 'C1', 'C2', 'C3'):
+            self.assertEqual(ledger.LEDGER.folio_status(folio), ledger.INVOICED)
+        self.assertEqual(ledger.LEDGER.folio_status('B1'), ledger.FAILED)
+        self.assertEqual(
+            ledger.LEDGER.execute('SELECT pdf_link FROM folios WHERE folio = ?', ('C3',)),
+            [('http://pdf/C1.pdf',)]
+        )
+        for _, timings in results:
+            self.assertEqual(set(timings), {'validate', 'register', 'facturar'})
+
+    def test_lot_that_breaks_before_invoicing_can_be_tried_again(self):
+        site = FakeInvoicingSite(1)
+        site.respond = lambda method, path, headers, body: (500, 'Error')
+        server = serve(self, site.respond)
+        ledger.LEDGER.claim_folios([ticket('D1')])
+
+        results = ADO.facturar_lotes([[ticket('D1')]], base_url=server.url)
+
+        self.assertEqual(results[0][0], None)
+        # Nothing reached facturar.jsp, so the claim is released
+        self.assertEqual(ledger.LEDGER.folio_status('D1'), ledger.FAILED)
+        self.assertEqual(ledger.LEDGER.claim_folios([ticket('D1')]), [ticket('D1')])
+
+
+class ClaimFoliosTest(StandInTestCase):
+
+    def test_only_new_and_failed_folios_are_claimed(self):
+        ledger.LEDGER.mark_folios([ticket('F1')], ledger.FAILED)
+        ledger.LEDGER.mark_folios([ticket('I1')], ledger.INVOICED)
+        ledger.LEDGER.mark_folios([ticket('P1')], ledger.INVOICING)
+
+        claimed = ledger.LEDGER.claim_folios([ticket('N1'), ticket('F1'), ticket('I1'), ticket('P1')])
+
+        self.assertEqual([t['folio'] for t in claimed], ['N1', 'F1'])
+        for folio in ('N1', 'F1', 'P1'):
+            self.assertEqual(ledger.LEDGER.folio_status(folio), ledger.INVOICING)
+        self.assertEqual(ledger.LEDGER.folio_status('I1'), ledger.INVOICED)
+        # Claimed folios can't be claimed again
+        self.assertEqual(ledger.LEDGER.claim_folios([ticket('N1'), ticket('F1')]), [])
+
+    def test_tickets_are_kept_by_folder(self):
+        ledger.LEDGER.add_tickets('email-1', 'folder-a', [ticket('A1')], ['2026-09'])
+        ledger.LEDGER.add_tickets('email-2', 'folder-b', [ticket('B1')], ['2026-09'])
+
+        self.assertEqual([t['folio'] for t in ledger.LEDGER.tickets_between('folder-a', '2026-09', '2026-10')], ['A1'])
+        self.assertEqual([t['folio'] for t in ledger.LEDGER.tickets_between('folder-b', '2026-09', '2026-10')], ['B1'])
+
+
+class FacturarAdoTest(StandInTestCase):
+    '''
+    facturar_ado runs of several units at the same time, on ADO's site stand-in
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.validated = []
+        self.invoiced = []
+        self.lock = threading.Lock()
+        self.corpus.stub(urlsplit(ADO.FACTURA_URL).netloc, self.respond)
+        for name, value in (('collect_ado', lambda account, folder_id: True),
+                            ('send_telegram_message', lambda text: True)):
+            patcher = mock.patch.object(main, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def respond(self, method, url, kwargs):
+        path = urlsplit(url).path
+        if path == ADO.VALIDATE_PATH:
+            with self.lock:
+                self.validated.append(kwargs['data']['folio'])
+            return 200, [{'IDL': kwargs['data']['folio']}]
+        if path == ADO.REGISTER_PATH:
+            return 200, REGISTER_PAGE
+        with self.lock:
+            self.invoiced.append(kwargs['data']['idlo'])
+        return 200, f'<button id="buttondwPDF" onclick="descargar(\'http://pdf/{kwargs["data"]["idlo"]}.pdf\')">PDF</button>'
+
+    def test_units_only_invoice_their_folder(self):
+        ledger.LEDGER.add_tickets('email-1', 'folder-a', [ticket('A1')], ['2026-09'])
+        ledger.LEDGER.add_tickets('email-2', 'folder-b', [ticket('B1')], ['2026-09'])
+
+        main.facturar_ado('2026-09', folder_id='folder-a')
+
+        self.assertEqual(self.invoiced, ['A1'])
+        self.assertIsNone(ledger.LEDGER.folio_status('B1'))
+
+    def test_concurrent_runs_never_invoice_a_folio_twice(self):
+        folios = [f'A{number}' for number in range(20)]
+        for folio in folios:
+            ledger.LEDGER.add_tickets(f'email-{folio}', 'folder-a', [ticket(folio)], ['2026-09'])
+
+        runs = [threading.Thread(target=main.facturar_ado, args=('2026-09',), kwargs={'folder_id': 'folder-a'})
+                for _ in range(4)]
+        for run in runs:
+            run.start()
+        for run in runs:
+            run.join()
+
+        # No folio reached ADO from two runs
+        self.assertEqual(sorted(self.validated), sorted(folios))
+        for folio in folios:
+            self.assertEqual(ledger.LEDGER.folio_status(folio), ledger.INVOICED)
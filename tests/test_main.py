@@ -0,0 +1,482 @@
+import os
+import time
+import datetime
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+import DC
+import main
+import state
+import benchmark
+import ledger
+import telegram_sender
+from tests.support import FakeDb, StandInTestCase, email
+
+
+FOLDER = 'dc-folder'
+UBER = email('uber-1', 'Uber Receipts', 'Tu viaje', '<p>Total</p><p>MX$123.40</p>')
+UBER_2 = email('uber-2', 'Uber Receipts', 'Tu viaje', '<p>Total</p><p>MX$50.00</p>')
+UNKNOWN = email('spam-1', 'Spam', 'Hola', '<p>nada</p>')
+ADO_TICKET = email('ado-1', 'ADO en Linea', 'Tu compra', '<a href="https://ado.example/boleto.pdf">Boleto</a>')
+
+
+class TokenTest(unittest.TestCase):
+
+    @mock.patch.object(main, 'TOKEN_MANAGERS', {})
+    @mock.patch.object(main, 'TokenManager')
+    def test_one_token_manager_per_account(self, token_manager):
+        main.get_token('hotmail')
+        main.get_token('hotmail')
+        main.get_token('work')
+
+        self.assertEqual(token_manager.call_args_list, [mock.call('hotmail'), mock.call('work')])
+        self.assertEqual(set(main.TOKEN_MANAGERS), {'hotmail', 'work'})
+
+
+class FakeTokenEndpoint:
+    '''
+    Stand-in for Microsoft's token endpoint. Hands out numbered tokens for the refresh
+    token it last issued, and rejects any other. Each request takes delay seconds
+    '''
+
+    def __init__(self, refresh_token, delay=0):
+        self.refresh_token = refresh_token
+        self.delay = delay
+        self.requests = []
+
+    def respond(self, method, url, kwargs):
+        self.requests.append(kwargs['data'])
+        time.sleep(self.delay)
+        if kwargs['data']['refresh_token'] != self.refresh_token:
+            return 400, {'error': 'invalid_grant', 'error_description': 'The refresh token has expired'}
+        self.refresh_token = f'refresh-{len(self.requests)}'
+        return 200, {'access_token': f'access-{len(self.requests)}', 'refresh_token': self.refresh_token,
+                     'expires_in': 3600}
+
+
+class TokenManagerTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = FakeDb({'refresh_tokens': {'hotmail': 'refresh-0'}})
+        self.now = 1000.0
+        for target, name, value in (
+            (main, 'STATE', state.StateStore(remote=lambda: self.db, path=os.path.join(self.scratch, 'state.sqlite3'))),
+            # Only main's clock is moved by hand
+            (main, 'time', mock.Mock(wraps=time, monotonic=lambda: self.now))
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.endpoint = FakeTokenEndpoint('refresh-0')
+        self.corpus.stub('login.microsoftonline.com', self.endpoint.respond)
+        self.manager = main.TokenManager('hotmail')
+
+    def test_token_is_only_refreshed_shortly_before_it_expires(self):
+        self.assertEqual(self.manager.get(), 'access-1')
+        self.assertEqual(main.STATE.get('refresh_tokens/hotmail'), 'refresh-1')
+
+        self.now += 3600 - main.TokenManager.REFRESH_MARGIN - 1
+        self.assertEqual(self.manager.get(), 'access-1')
+        self.assertEqual(len(self.endpoint.requests), 1)
+
+        self.now += 1
+        self.assertEqual(self.manager.get(), 'access-2')
+        # The rotated refresh token is the one used
+        self.assertEqual([request['refresh_token'] for request in self.endpoint.requests], ['refresh-0', 'refresh-1'])
+
+    def test_threads_wait_for_a_single_refresh(self):
+        self.endpoint.delay = 0.2
+        barrier = threading.Barrier(8)
+        tokens = []
+
+        def get():
+            barrier.wait()
+            tokens.append(self.manager.get())
+
+        threads = [threading.Thread(target=get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['access-1'] * 8)
+        self.assertEqual(len(self.endpoint.requests), 1)
+
+    def test_rejected_refresh_token_is_read_again_from_firebase(self):
+        self.assertEqual(self.manager.get(), 'access-1')
+        main.STATE.flush()
+        # Another process refreshed with the same token, and firebase has the one it got
+        self.endpoint.refresh_token = 'refresh-elsewhere'
+        self.db.reference('/').update({'refresh_tokens/hotmail': 'refresh-elsewhere',
+                                       'state_versions/refresh_tokens/hotmail': 'elsewhere'})
+        self.now += 3600
+
+        with self.assertRaises(RuntimeError):
+            self.manager.get()
+
+        self.assertEqual(self.manager.get(), 'access-3')
+        self.assertEqual(self.endpoint.requests[-1]['refresh_token'], 'refresh-elsewhere')
+
+
+class TransactionMessageTest(unittest.TestCase):
+
+    def test_messages_match_the_concatenated_ones(self):
+        # An expense (gets the account), an ADO ticket (float amount and tag), notes and a transfer
+        for transaction in benchmark.RENDER_TRANSACTIONS:
+            with self.subTest(description=transaction['description']):
+                url, text = benchmark.concatenated_transaction_message(transaction, '2026-10-18, 09:30')
+
+                self.assertEqual(DC.render_transaction(DC.Transaction.from_dict(transaction), '2026-10-18, 09:30'), (url, text))
+                self.assertEqual(main.build_transaction_message(transaction, '2026-10-18, 09:30'), text)
+
+    def test_parser_dicts_are_left_as_they_are(self):
+        transaction = dict(benchmark.RENDER_TRANSACTIONS[0])
+
+        main.build_transaction_message(transaction, '2026-10-18, 09:30')
+
+        self.assertEqual(transaction, benchmark.RENDER_TRANSACTIONS[0])
+
+
+class SchedulerTest(unittest.TestCase):
+
+    UNITS = [
+        {'account': 'hotmail', 'job': 'debit_and_credit', 'folder_id': 'dc-folder'},
+        {'account': 'hotmail', 'job': 'facturar_ado', 'folder_id': 'ado-folder'}
+    ]
+
+    def job_ids(self, process_type, notification_url):
+        with mock.patch.object(main, 'NOTIFICATION_URL', notification_url):
+            scheduler = main.create_scheduler(self.UNITS, process_type)
+        return {job.id.split(':')[0] for job in scheduler.get_jobs()}
+
+    def test_one_process_runs_everything(self):
+        for notification_url in (None, 'https://example.com/notifications'):
+            with self.subTest(notification_url=notification_url):
+                self.assertEqual(
+                    self.job_ids(None, notification_url),
+                    {'debit_and_credit', 'collect_ado', 'facturar_ado', 'renew_subscription', 'metrics_summary'}
+                )
+
+    def test_d_and_c_runs_in_web_only_with_notifications(self):
+        self.assertEqual(
+            self.job_ids(main.WEB, 'https://example.com/notifications'),
+            {'debit_and_credit', 'renew_subscription', 'metrics_summary'}
+        )
+        self.assertEqual(
+            self.job_ids(main.CLOCK, 'https://example.com/notifications'),
+            {'collect_ado', 'facturar_ado', 'metrics_summary'}
+        )
+
+    def test_d_and_c_runs_in_clock_without_notifications(self):
+        self.assertEqual(self.job_ids(main.WEB, None), {'renew_subscription', 'metrics_summary'})
+        self.assertEqual(
+            self.job_ids(main.CLOCK, None),
+            {'debit_and_credit', 'collect_ado', 'facturar_ado', 'metrics_summary'}
+        )
+
+
+class FakeGraph:
+    '''
+    Stand-in for Graph: serves listing pages by path and $skip,
+    and answers $batch deletes with 204
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        self.deleted = []
+
+    def respond(self, method, url, kwargs):
+        self.requests.append((method, url))
+        parts = urlsplit(url)
+        if method == 'POST' and parts.path.endswith('/$batch'):
+            batch = kwargs['json']['requests']
+            self.deleted.extend(request['url'].rsplit('/', 1)[1] for request in batch)
+            return 200, {'responses': [{'id': request['id'], 'status': 204} for request in batch]}
+        skip = parse_qs(parts.query).get('$skip', ['0'])[0]
+        return 200, self.pages[(parts.path, skip)]
+
+
+class GraphSyncTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.db = FakeDb()
+        for target, name, value in (
+            (main, 'STATE', state.StateStore(remote=lambda: self.db, path=os.path.join(self.scratch, 'state.sqlite3'))),
+            (main, 'get_token', lambda account=None: 'token'),
+            (telegram_sender, 'CHAT_INTERVAL', 0)
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.messages = []
+        self.corpus.stub('api.telegram.org', self.telegram)
+
+    def telegram(self, method, url, kwargs):
+        self.messages.append(kwargs['data']['text'])
+        return 200, {'ok': True}
+
+    def listing(self, *pages):
+        '''
+        Serves the given lists of emails as the pages of the folder listing
+        '''
+        path = f'/v1.0/me/mailFolders/{FOLDER}/messages'
+        served = {}
+        for number, emails in enumerate(pages):
+            page = {'value': emails}
+            if number < len(pages) - 1:
+                page['@odata.nextLink'] = f'https://graph.microsoft.com{path}?$skip={number + 1}'
+            served[(path, str(number))] = page
+        graph = FakeGraph(served)
+        self.corpus.stub('graph.microsoft.com', graph.respond)
+        return graph
+
+    def delta(self, *pages, delta_link='https://graph.microsoft.com/delta?token=next'):
+        '''
+        Serves the given lists of emails as the pages of the folder's delta query
+        '''
+        path = f'/v1.0/me/mailFolders/{FOLDER}/messages/delta'
+        served = {}
+        for number, emails in enumerate(pages):
+            page = {'value': emails}
+            if number < len(pages) - 1:
+                page['@odata.nextLink'] = f'https://graph.microsoft.com{path}?$skip={number + 1}'
+            else:
+                page['@odata.deltaLink'] = delta_link
+            served[(path, str(number))] = page
+        graph = FakeGraph(served)
+        self.corpus.stub('graph.microsoft.com', graph.respond)
+        return graph
+
+    def test_listing_follows_next_links_with_selected_fields(self):
+        graph = self.listing([UBER], [UNKNOWN], [UBER_2])
+
+        pages = list(main.iter_folder_pages('token', FOLDER))
+
+        self.assertEqual([[e['id'] for e in page['value']] for page in pages], [['uber-1'], ['spam-1'], ['uber-2']])
+        first_url = graph.requests[0][1]
+        self.assertIn(f'$select={main.MAIL_FIELDS}', first_url)
+        self.assertIn(f'$top={main.MAIL_PAGE_SIZE}', first_url)
+        # Without delta sync there's no delta link to look up
+        self.assertEqual(self.db.reads, [])
+
+    def test_automation_processes_every_page_and_deletes_afterwards(self):
+        graph = self.listing([UBER, UNKNOWN], [UBER_2])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(sorted(graph.deleted), ['uber-1', 'uber-2'])
+        # Every listing request comes before the first delete
+        methods = [method for method, _ in graph.requests]
+        self.assertEqual(methods, ['GET', 'GET', 'POST'])
+        self.assertEqual(ledger.LEDGER.message_status('uber-1'), ledger.DELETED)
+        self.assertIsNone(ledger.LEDGER.message_status('spam-1'))
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta'})
+    def test_delta_starts_from_saved_link_and_skips_removed(self):
+        saved = f'https://graph.microsoft.com/v1.0/me/mailFolders/{FOLDER}/messages/delta?$skip=0'
+        self.db.data = {'delta_links': {FOLDER: saved}}
+        graph = self.delta([UBER, {'id': 'gone', '@removed': {'reason': 'deleted'}}])
+
+        pages = list(main.iter_folder_pages('token', FOLDER))
+
+        self.assertEqual(graph.requests[0][1], saved)
+        self.assertEqual([e['id'] for e in pages[0]['value']], ['uber-1'])
+        self.assertEqual(pages[-1]['@odata.deltaLink'], 'https://graph.microsoft.com/delta?token=next')
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta'})
+    def test_delta_link_saved_when_every_email_is_done(self):
+        self.delta([UBER], [UNKNOWN])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        # Emails without a rule don't hold the delta link back
+        self.assertEqual(main.STATE.get(f'delta_links/{FOLDER}'), 'https://graph.microsoft.com/delta?token=next')
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta'})
+    def test_delta_link_kept_when_a_parse_fails(self):
+        def unreachable(method, url, kwargs):
+            raise requests.exceptions.ConnectionError('ado is down')
+
+        self.corpus.stub('ado.example', unreachable)
+        self.delta([UBER, ADO_TICKET])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        # The ADO email has to be listed again on the next run
+        self.assertIsNone(main.STATE.get(f'delta_links/{FOLDER}'))
+        self.assertIsNone(ledger.LEDGER.message_status('ado-1'))
+        self.assertEqual(ledger.LEDGER.message_status('uber-1'), ledger.DELETED)
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta'})
+    def test_delta_link_kept_when_a_message_is_not_sent(self):
+        self.corpus.stub('api.telegram.org', lambda method, url, kwargs: (400, {'ok': False}))
+        self.delta([UBER])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        self.assertIsNone(main.STATE.get(f'delta_links/{FOLDER}'))
+        self.assertIsNone(ledger.LEDGER.message_status('uber-1'))
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta'})
+    def test_ado_collection_ignores_delta_links_of_another_store(self):
+        # A restart with a new ledger must list the folder from scratch,
+        # whatever delta link firebase has for it
+        self.db.data = {'delta_links': {FOLDER: 'https://graph.microsoft.com/stale'}}
+        no_ticket = email('ado-2', 'ADO en Linea', 'Promociones', '<p>Viaja</p>')
+        graph = self.delta([no_ticket])
+
+        self.assertTrue(main.collect_ado(folder_id=FOLDER))
+
+        self.assertTrue(graph.requests[0][1].endswith(f'/mailFolders/{FOLDER}/messages/delta?$select={main.MAIL_FIELDS}'))
+        self.assertTrue(ledger.LEDGER.is_collected('ado-2'))
+        self.assertEqual(ledger.LEDGER.delta_link(FOLDER), 'https://graph.microsoft.com/delta?token=next')
+        self.assertEqual(self.db.data['delta_links'][FOLDER], 'https://graph.microsoft.com/stale')
+
+    @mock.patch.dict(os.environ, {'DC_PIPELINE': 'async'})
+    def test_async_pipeline_deletes_after_a_full_listing(self):
+        graph = self.listing([UBER, UNKNOWN], [UBER_2], [UNKNOWN])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        self.assertEqual(sorted(graph.deleted), ['uber-1', 'uber-2'])
+        # Every listing request comes before the first delete, so no page shifts
+        methods = [method for method, _ in graph.requests]
+        self.assertEqual(methods, ['GET', 'GET', 'GET', 'POST'])
+        self.assertEqual(ledger.LEDGER.message_status('uber-2'), ledger.DELETED)
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta', 'DC_PIPELINE': 'async'})
+    def test_async_pipeline_saves_the_delta_link_when_every_email_is_done(self):
+        graph = self.delta([UBER, UNKNOWN], [UBER_2])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        self.assertEqual(len(self.messages), 2)
+        self.assertEqual(sorted(graph.deleted), ['uber-1', 'uber-2'])
+        self.assertEqual(main.STATE.get(f'delta_links/{FOLDER}'), 'https://graph.microsoft.com/delta?token=next')
+
+    @mock.patch.dict(os.environ, {'MAIL_SYNC_MODE': 'delta', 'DC_PIPELINE': 'async'})
+    def test_async_pipeline_keeps_the_delta_link_when_a_parse_fails(self):
+        def unreachable(method, url, kwargs):
+            raise requests.exceptions.ConnectionError('ado is down')
+
+        self.corpus.stub('ado.example', unreachable)
+        self.delta([UBER, ADO_TICKET])
+
+        main.debit_and_credit_automation(folder_id=FOLDER)
+
+        self.assertIsNone(main.STATE.get(f'delta_links/{FOLDER}'))
+        self.assertEqual(ledger.LEDGER.message_status('uber-1'), ledger.DELETED)
+
+    def test_ado_email_with_an_error_page_for_a_pdf_is_not_collected(self):
+        self.corpus.stub('ado.example', lambda method, url, kwargs: (503, '<html>Service Unavailable</html>'))
+        self.listing([ADO_TICKET])
+
+        self.assertFalse(main.collect_ado(folder_id=FOLDER))
+
+        self.assertFalse(ledger.LEDGER.is_collected('ado-1'))
+
+    def test_ado_email_with_unread_pages_is_not_collected_and_reported_once(self):
+        extracted = {'tickets': [{'folio': '1'}], 'failures': [{'page': 1, 'missing': ['seat', 'price']}]}
+        self.listing([ADO_TICKET])
+
+        with mock.patch.object(main.ADO.pdf_cache, 'extract', lambda link, name, extractor: extracted):
+            self.assertFalse(main.collect_ado(folder_id=FOLDER))
+            self.assertFalse(main.collect_ado(folder_id=FOLDER))
+
+        self.assertFalse(ledger.LEDGER.is_collected('ado-1'))
+        self.assertEqual(ledger.LEDGER.tickets_between(FOLDER, '0000-00', '9999-99'), [])
+        message, = self.messages
+        self.assertIn('https://ado.example/boleto.pdf', message)
+        self.assertIn('seat, price from page 1', message)
+
+
+class DeleteEmailsTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(main, 'GRAPH_BATCH_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batches = []
+        self.emails = [email(f'email-{number}', 'Uber Receipts', f'Viaje {number}', '') for number in range(4)]
+
+    def graph(self, *answers):
+        '''
+        Answers every $batch request with the next of answers, a function of the
+        requested message ids that returns (status, body)
+        '''
+        answers = iter(answers)
+
+        def respond(method, url, kwargs):
+            message_ids = {request['id']: request['url'].rsplit('/', 1)[1] for request in kwargs['json']['requests']}
+            self.batches.append(sorted(message_ids.values()))
+            return next(answers)(message_ids)
+
+        self.corpus.stub('graph.microsoft.com', respond)
+
+    @staticmethod
+    def items(statuses, headers=None):
+        '''
+        Batch answer with the status of each message id, 204 by default
+        '''
+        return lambda message_ids: (200, {'responses': [
+            {'id': request_id, 'status': statuses.get(message_id, 204), 'headers': headers or {}}
+            for request_id, message_id in message_ids.items()
+        ]})
+
+    def test_throttled_and_failed_items_are_retried(self):
+        self.graph(
+            self.items({'email-1': 429, 'email-2': 503, 'email-3': 503}, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+            self.items({'email-2': 503, 'email-3': 503}),
+            self.items({'email-3': 503}),
+            self.items({'email-3': 503})
+        )
+
+        deleted = main.delete_emails_in_folder(self.emails, 'token', FOLDER)
+
+        self.assertEqual([e['id'] for e in deleted], ['email-0', 'email-1', 'email-2'])
+        self.assertEqual(self.batches, [
+            ['email-0', 'email-1', 'email-2', 'email-3'],
+            ['email-1', 'email-2', 'email-3'],
+            ['email-2', 'email-3'],
+            ['email-3']
+        ])
+
+    def test_throttled_batch_is_retried(self):
+        self.graph(lambda message_ids: (503, {'error': {'code': 'ServiceUnavailable'}}), self.items({}))
+
+        with mock.patch.object(main.time, 'sleep') as sleep:
+            deleted = main.delete_emails_in_folder(self.emails, 'token', FOLDER)
+
+        self.assertEqual(len(deleted), 4)
+        self.assertEqual(len(self.batches), 2)
+        sleep.assert_called_once_with(0)
+
+    def test_rejected_batch_is_not_retried(self):
+        for status in (400, 401):
+            with self.subTest(status=status):
+                self.batches.clear()
+                self.graph(lambda message_ids: (status, {'error': {'code': 'BadRequest'}}))
+
+                self.assertEqual(main.delete_emails_in_folder(self.emails, 'token', FOLDER), [])
+                self.assertEqual(len(self.batches), 1)
+
+    def test_retry_after_in_seconds_or_as_a_date(self):
+        in_a_minute = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+
+        self.assertEqual(main.retry_after_seconds({'Retry-After': '7'}), 7)
+        self.assertAlmostEqual(
+            main.retry_after_seconds({'Retry-After': in_a_minute.strftime('%a, %d %b %Y %H:%M:%S GMT')}), 60, delta=2
+        )
+        for value in ('Wed, 21 Oct 2015 07:28:00 GMT', 'soon', '', '-5'):
+            with self.subTest(value=value):
+                self.assertEqual(main.retry_after_seconds({'Retry-After': value}), 0)
+        self.assertEqual(main.retry_after_seconds({}), 0)
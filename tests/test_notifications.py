@@ -0,0 +1,137 @@
+import os
+import json
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+import state
+import notifications
+from tests.support import FakeDb, serve
+
+
+FOLDER = 'dc-folder'
+
+
+class FakeGraphSubscriptions:
+    '''
+    Stand-in for Graph's /subscriptions, which creates subscriptions
+    and renews those it knows
+    '''
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.created = 0
+
+    def respond(self, method, path, headers, body):
+        if method == 'POST' and path == '/subscriptions':
+            subscription = json.loads(body)
+            self.created += 1
+            subscription['id'] = f'subscription-{self.created}'
+            self.subscriptions[subscription['id']] = subscription
+            return 201, subscription
+        subscription_id = path.rsplit('/', 1)[1]
+        if subscription_id not in self.subscriptions:
+            return 404, {'error': {'code': 'ResourceNotFound'}}
+        if method == 'DELETE':
+            del self.subscriptions[subscription_id]
+            return 204, b''
+        self.subscriptions[subscription_id].update(json.loads(body))
+        return 200, self.subscriptions[subscription_id]
+
+
+class NotificationListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = FakeGraphSubscriptions()
+        self.graph_server = serve(self, self.graph.respond)
+        self.store = state.StateStore(remote=FakeDb, path=':memory:')
+        self.runs = []
+        self.ran = threading.Semaphore(0)
+
+    def handler(self):
+        self.runs.append(FOLDER)
+        self.ran.release()
+
+    def start_listener(self):
+        listener = notifications.NotificationListener(
+            self.handler, lambda: 'token', FOLDER, 'https://example.com/notifications', 0,
+            store=self.store, graph_url=self.graph_server.url
+        )
+        listener.start()
+        self.addCleanup(listener.stop)
+        # The folder is processed once on start
+        self.assertTrue(self.ran.acquire(timeout=5))
+        return listener, f'http://127.0.0.1:{listener.server.server_address[1]}'
+
+    def post_notifications(self, url, *notifications_sent):
+        return requests.post(url, json={'value': list(notifications_sent)}, timeout=5)
+
+    def test_subscribes_and_answers_the_validation_handshake(self):
+        listener, url = self.start_listener()
+
+        self.assertTrue(listener.is_active())
+        subscription, = self.graph.subscriptions.values()
+        self.assertEqual(subscription['resource'], f"me/mailFolders('{FOLDER}')/messages")
+        self.assertEqual(subscription['clientState'], listener.client_state)
+
+        response = requests.post(f'{url}/?validationToken=abc%20123', timeout=5)
+        self.assertEqual((response.status_code, response.text), (200, 'abc 123'))
+
+    def test_notifications_run_the_handler(self):
+        listener, url = self.start_listener()
+
+        response = self.post_notifications(
+            url,
+            {'clientState': listener.client_state, 'changeType': 'created'},
+            {'clientState': listener.client_state, 'changeType': 'created'}
+        )
+
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(self.ran.acquire(timeout=5))
+        # At most one run per batch, never one per notification
+        self.assertFalse(self.ran.acquire(timeout=0.5))
+
+    def test_notifications_with_another_client_state_are_ignored(self):
+        _, url = self.start_listener()
+
+        self.post_notifications(url, {'clientState': 'someone else', 'changeType': 'created'})
+
+        self.assertFalse(self.ran.acquire(timeout=0.5))
+        self.assertEqual(len(self.runs), 1)
+
+    def test_removed_subscription_falls_back_to_polling(self):
+        listener, url = self.start_listener()
+
+        self.post_notifications(url, {'clientState': listener.client_state, 'lifecycleEvent': 'subscriptionRemoved'})
+
+        self.assertFalse(self.ran.acquire(timeout=0.5))
+        self.assertFalse(listener.is_active())
+        listener.renew()
+        self.assertTrue(listener.is_active())
+
+    @mock.patch.dict(os.environ, {'GRAPH_CLIENT_STATE': ''})
+    def test_restart_keeps_client_state_and_subscription(self):
+        first, _ = self.start_listener()
+        first.stop()
+
+        second, url = self.start_listener()
+
+        self.assertEqual(second.client_state, first.client_state)
+        self.assertEqual(second.subscription_id, first.subscription_id)
+        # Renewed, not created again
+        self.assertEqual(list(self.graph.subscriptions), [first.subscription_id])
+
+        self.post_notifications(url, {'clientState': first.client_state, 'changeType': 'created'})
+        self.assertTrue(self.ran.acquire(timeout=5))
+
+    def test_restart_replaces_a_subscription_graph_forgot(self):
+        first, _ = self.start_listener()
+        first.stop()
+        self.graph.subscriptions.clear()
+
+        second, _ = self.start_listener()
+
+        self.assertNotEqual(second.subscription_id, first.subscription_id)
+        self.assertEqual(self.store.get(f'subscriptions/{FOLDER}')['id'], second.subscription_id)
@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures.process import BrokenProcessPool
+
+import requests
+
+import DC
+from tests.support import email
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'emails')
+
+# Fixture file, sender, subject and the transaction it has, also cycled by benchmark.py
+with open(os.path.join(FIXTURES, 'emails.json'), encoding='utf-8') as manifest:
+    CASES = tuple((case['file'], case['sender'], case['subject'], case['transaction']) for case in json.load(manifest))
+
+HTML_PARSERS = ('html.parser', 'lxml')
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as fixture:
+        return fixture.read()
+
+
+def exit_process(email):
+    '''
+    Stand-in for DC.parse_email in a process that dies
+    '''
+    os._exit(1)
+
+
+def full_soup(html, only=None):
+    '''
+    make_soup as it was before parsers said which tags they need
+    '''
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, DC.HTML_PARSER)
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+    '''
+    The parsers read restricted soups (SoupStrainer), streamed text (TextFinder)
+    or the raw html. They have to find the same transactions as on a full soup
+    '''
+
+    def test_fixtures_parse_to_their_transactions(self):
+        for name, sender, subject, expected in CASES:
+            with self.subTest(name):
+                self.assertEqual(DC.process_email(email(name, sender, subject, load(name))), expected)
+
+    def test_restricted_soups_match_full_soups(self):
+        for html_parser in HTML_PARSERS:
+            for name, sender, subject, _ in CASES:
+                with self.subTest(name, html_parser=html_parser), \
+                        mock.patch.object(DC, 'HTML_PARSER', html_parser):
+                    message = email(name, sender, subject, load(name))
+                    restricted = DC.process_email(message)
+                    with mock.patch.object(DC, 'make_soup', full_soup):
+                        self.assertEqual(restricted, DC.process_email(message))
+
+    def test_cinepolis_siblings_survive_the_strainer(self):
+        # The title is the fourth child of the span's parent, which is inside a tr
+        soup = DC.make_soup(load('cinepolis.html'), ['tr'])
+        span = soup.find('span', string=re.compile('Película:'))
+        self.assertEqual(span.parent.name, 'td')
+        self.assertEqual(span.parent.contents[3].text, 'DUNE PARTE DOS SUB')
+
+    def test_text_finder_matches_soup_search(self):
+        for name in ('uber.html', 'uber_eats.html'):
+            html = load(name)
+            with self.subTest(name):
+                self.assertEqual(
+                    DC.first_text(html, DC.UBER_AMOUNT_PATTERN),
+                    str(full_soup(html).find(string=DC.UBER_AMOUNT_PATTERN))
+                )
+
+    def test_parkimovil_place_matches_serialized_soup(self):
+        from html import unescape
+
+        html = load('parkimovil.html')
+        self.assertEqual(
+            DC.PARKIMOVIL_PLACE_PATTERN.search(unescape(html)).group(1),
+            DC.PARKIMOVIL_PLACE_PATTERN.search(str(full_soup(html))).group(1)
+        )
+
+
+class ProcessEmailsTest(unittest.TestCase):
+
+    def setUp(self):
+        pools = {}
+        for name, value in (('FAILURE_COUNTS', {}), ('QUARANTINED_EMAIL_IDS', set()), ('PROFILE', {}),
+                            ('PROCESS_POOLS', pools)):
+            patcher = mock.patch.object(DC, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: [pool.shutdown() for pool in pools.values()])
+        self.emails = [email(name, sender, subject, load(name)) for name, sender, subject, _ in CASES]
+        self.emails.append(email('spam-1', 'Spam', 'Hola', '<p>nada</p>'))
+
+    def test_process_pool_parses_like_threads(self):
+        on_threads = DC.process_emails(self.emails, workers=2, processes=0)
+        on_processes = DC.process_emails(self.emails, workers=2, processes=2)
+
+        self.assertEqual([result for result, _ in on_processes], [result for result, _ in on_threads])
+        self.assertEqual([result for result, _ in on_processes[:-1]], [expected for *_, expected in CASES])
+        self.assertIsInstance(on_processes[-1][1], DC.NoRuleError)
+        # Parses in the pool are recorded here, in the parent process
+        self.assertEqual(sum(len(profile['durations']) for profile in DC.PROFILE.values()), 2 * len(CASES))
+
+    def test_process_pool_is_kept_between_calls(self):
+        DC.process_emails(self.emails[:1], workers=1, processes=2)
+        pool = DC.get_process_pool(2)
+
+        DC.process_emails(self.emails[1:], workers=1, processes=2)
+
+        self.assertIs(DC.get_process_pool(2), pool)
+
+    def test_broken_process_pool_is_replaced(self):
+        pool = DC.get_process_pool(2)
+        # A parse process that dies breaks the whole pool
+        pool.submit(os._exit, 1).exception()
+
+        results = DC.process_emails(self.emails[:1], workers=1, processes=2)
+
+        self.assertEqual(results, [(CASES[0][3], None)])
+        self.assertIsNot(DC.get_process_pool(2), pool)
+
+    def test_parses_lost_with_a_process_are_errors(self):
+        with mock.patch.object(DC, 'parse_email', exit_process):
+            results = DC.process_emails(self.emails[:1], workers=1, processes=2)
+
+        self.assertIsInstance(results[0][1], BrokenProcessPool)
+        # Not counted against the parser
+        self.assertEqual(DC.FAILURE_COUNTS, {})
+        self.assertEqual(DC.process_emails(self.emails[:1], workers=1, processes=2), [(CASES[0][3], None)])
+
+
+class QuarantineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.failure_dir = tempfile.mkdtemp(dir=os.environ.get('TMPDIR'))
+        for name, value in (('FAILURE_DIR', self.failure_dir), ('FAILURE_COUNTS', {}),
+                            ('QUARANTINED_EMAIL_IDS', set()), ('PROFILE', {})):
+            patcher = mock.patch.object(DC, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.email = email('bbva-1', 'Clientes BBVA', 'Retiro sin tarjeta', '<p>Sin importe</p>')
+
+    def record_failures(self, error, times=DC.QUARANTINE_AFTER):
+        for _ in range(times):
+            DC.record_parse(self.email, error, 0.01)
+
+    def samples(self):
+        return os.listdir(os.path.join(self.failure_dir, 'process_bbva_retiro'))
+
+    def test_parser_errors_quarantine_the_email(self):
+        _, error, _ = DC.parse_email(self.email)
+        self.assertIsInstance(error, AttributeError)
+
+        self.record_failures(error)
+
+        self.assertIn('bbva-1', DC.QUARANTINED_EMAIL_IDS)
+        self.assertIsNone(DC.match_email(self.email))
+        self.assertEqual(len(self.samples()), 2)
+        self.assertEqual(DC.parser_stats()['process_bbva_retiro']['failure_rate'], 1)
+
+    def test_network_and_os_errors_do_not_count(self):
+        for error in (requests.exceptions.ConnectionError('down'), requests.exceptions.HTTPError('503'),
+                      requests.exceptions.JSONDecodeError('Expecting value', '', 0), OSError('disk full')):
+            with self.subTest(error=error):
+                self.record_failures(error)
+
+                self.assertNotIn('bbva-1', DC.QUARANTINED_EMAIL_IDS)
+                self.assertEqual(DC.FAILURE_COUNTS, {})
+                self.assertFalse(os.path.exists(os.path.join(self.failure_dir, 'process_bbva_retiro')))
+
+    def test_network_errors_neither_count_nor_reset_failures_in_a_row(self):
+        parser_error = IndexError('list index out of range')
+        self.record_failures(parser_error, DC.QUARANTINE_AFTER - 1)
+        self.record_failures(requests.exceptions.ConnectionError('down'))
+        self.assertNotIn('bbva-1', DC.QUARANTINED_EMAIL_IDS)
+
+        self.record_failures(parser_error, 1)
+        self.assertIn('bbva-1', DC.QUARANTINED_EMAIL_IDS)
+
+    def test_a_parse_that_works_resets_failures(self):
+        parser_error = IndexError('list index out of range')
+        self.record_failures(parser_error, DC.QUARANTINE_AFTER - 1)
+        DC.record_parse(self.email, None, 0.01)
+        self.record_failures(parser_error, DC.QUARANTINE_AFTER - 1)
+
+        self.assertNotIn('bbva-1', DC.QUARANTINED_EMAIL_IDS)
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+import pdf_cache
+from tests.support import serve
+
+
+def pdf(text):
+    '''
+    Returns the bytes of a one page PDF with text on it
+    '''
+    stream = f'BT /F1 12 Tf 72 712 Td ({text}) Tj ET'.encode()
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R'
+        b' /Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'
+    ]
+    content = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(content))
+        content += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(content)
+    content += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    content += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    content += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return content
+
+
+class PdfCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp(dir=os.environ.get('TMPDIR'))
+        for name, value in (('CACHE_DIR', cache_dir), ('INDEX_PATH', os.path.join(cache_dir, 'index.json'))):
+            patcher = mock.patch.object(pdf_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # PDFs served by path
+        self.pdfs = {
+            '/first.pdf': pdf('FIRST TICKET'),
+            '/copy.pdf': pdf('FIRST TICKET'),
+            '/second.pdf': pdf('SECOND TICKET'),
+            '/third.pdf': pdf('THIRD TICKET'),
+            '/broken.pdf': b'%PDF-1.4\nnot really a pdf'
+        }
+        self.server = serve(self, lambda method, path, headers, body: (200, self.pdfs[path]) if path in self.pdfs
+                            else (404, '<html>Not Found</html>'))
+        self.read_pages = mock.Mock(wraps=pdf_cache.read_pages)
+        patcher = mock.patch.object(pdf_cache, 'read_pages', self.read_pages)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url(self, path):
+        return f'{self.server.url}{path}'
+
+    def cached_hashes(self):
+        return {name[:-len('.pdf')] for name in os.listdir(pdf_cache.CACHE_DIR) if name.endswith('.pdf')}
+
+    def test_hit_neither_downloads_nor_parses(self):
+        pages = pdf_cache.get_pages(self.url('/first.pdf'))
+        self.assertIn('FIRST TICKET', pages[0])
+
+        self.assertEqual(pdf_cache.get_pages(self.url('/first.pdf')), pages)
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.read_pages.call_count, 1)
+
+    def test_extracted_fields_are_cached(self):
+        extractor = mock.Mock(return_value={'tickets': []})
+
+        for _ in range(2):
+            self.assertEqual(pdf_cache.extract(self.url('/first.pdf'), 'tickets', extractor), {'tickets': []})
+
+        extractor.assert_called_once()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_same_pdf_under_two_urls_is_kept_once(self):
+        first = pdf_cache.get_hash(self.url('/first.pdf'))
+        copy = pdf_cache.get_hash(self.url('/copy.pdf'))
+
+        self.assertEqual(first, copy)
+        self.assertEqual(self.cached_hashes(), {first})
+        # Downloaded to know its hash, but parsed once
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.read_pages.call_count, 1)
+        self.assertEqual(pdf_cache.load_index()['urls'], {self.url('/first.pdf'): first, self.url('/copy.pdf'): first})
+
+    def test_least_recently_used_pdfs_are_evicted(self):
+        first = pdf_cache.get_hash(self.url('/first.pdf'))
+        entry_size = pdf_cache.load_index()['entries'][first]['size']
+
+        with mock.patch.object(pdf_cache, 'MAX_BYTES', 2 * entry_size + entry_size // 2):
+            second = pdf_cache.get_hash(self.url('/second.pdf'))
+            # Used again, so second is now the least recently used
+            pdf_cache.get_hash(self.url('/first.pdf'))
+            third = pdf_cache.get_hash(self.url('/third.pdf'))
+
+            index = pdf_cache.load_index()
+            self.assertEqual(set(index['entries']), {first, third})
+            self.assertEqual(self.cached_hashes(), {first, third})
+            self.assertNotIn(self.url('/second.pdf'), index['urls'])
+            self.assertLessEqual(sum(entry['size'] for entry in index['entries'].values()), pdf_cache.MAX_BYTES)
+            self.assertNotEqual(second, third)
+
+        # Evicted PDFs are downloaded again
+        requests_made = len(self.server.requests)
+        pdf_cache.get_pages(self.url('/second.pdf'))
+        self.assertEqual(len(self.server.requests), requests_made + 1)
+
+    def test_parse_failures_are_not_cached(self):
+        from PyPDF2.utils import PdfReadError
+
+        for attempt in range(2):
+            with self.subTest(attempt=attempt), self.assertRaises(PdfReadError):
+                pdf_cache.get_pages(self.url('/broken.pdf'))
+
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.cached_hashes(), set())
+        self.assertEqual(pdf_cache.load_index()['urls'], {})
+
+    def test_error_statuses_are_raised_and_not_cached(self):
+        with self.assertRaises(requests.exceptions.HTTPError):
+            pdf_cache.get_pages(self.url('/missing.pdf'))
+
+        self.read_pages.assert_not_called()
+        self.assertFalse(os.path.exists(pdf_cache.INDEX_PATH))
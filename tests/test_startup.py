@@ -0,0 +1,44 @@
+import os
+import re
+import sys
+import subprocess
+import unittest
+
+
+# Most main can take to import, cumulative microseconds reported by -X importtime
+IMPORT_BUDGET = int(os.getenv('IMPORT_BUDGET_US', '1000000'))
+# Only imported by the jobs that need them
+LAZY_MODULES = ('bs4', 'PyPDF2', 'firebase_admin', 'apscheduler', 'nltk')
+
+IMPORT_TIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+
+class StartupTest(unittest.TestCase):
+
+    def import_main(self):
+        '''
+        Imports main in a new interpreter with -X importtime.
+        Returns the lazy modules it loaded and {module: cumulative microseconds}
+        '''
+        code = f'import sys, main; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        )
+        times = {}
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_PATTERN.match(line)
+            if match:
+                times[match.group(4)] = int(match.group(2))
+        return [name for name in result.stdout.strip().split(',') if name], times
+
+    def test_heavy_dependencies_are_not_imported(self):
+        loaded, _ = self.import_main()
+        self.assertEqual(loaded, [])
+
+    def test_import_time_budget(self):
+        _, times = self.import_main()
+        slowest = sorted(times.items(), key=lambda item: -item[1])[:10]
+        report = '\n'.join(f'{us / 1000:8.1f}ms {name}' for name, us in slowest)
+        self.assertLessEqual(times['main'], IMPORT_BUDGET, f'Slowest imports:\n{report}')
@@ -0,0 +1,119 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import state
+from tests.support import FakeDb
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDb({'refresh_tokens': {'hotmail': 'token-1'}})
+        self.path = os.path.join(tempfile.mkdtemp(dir=os.environ.get('TMPDIR')), 'state.sqlite3')
+        self.store = self.new_store()
+
+    def new_store(self):
+        '''
+        Returns a store over the same local file, like the one of a restarted process
+        '''
+        store = state.StateStore(remote=lambda: self.db, path=self.path)
+        # Writes are flushed by hand, the background worker is not started
+        patcher = mock.patch.object(store, 'pending')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        store.worker = mock.Mock(is_alive=lambda: True)
+        return store
+
+    def test_first_read_goes_to_firebase_then_stays_local(self):
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-1')
+        reads = len(self.db.reads)
+
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-1')
+        self.assertEqual(len(self.db.reads), reads)
+
+    def test_unchanged_version_only_reads_the_version(self):
+        self.store.set('delta_links/folder', 'link-1')
+        self.assertTrue(self.store.flush())
+        self.db.reads.clear()
+
+        with mock.patch.object(state, 'CHECK_SECONDS', 0):
+            self.assertEqual(self.store.get('delta_links/folder'), 'link-1')
+
+        self.assertEqual(self.db.reads, ['state_versions/delta_links/folder'])
+
+    def test_value_changed_elsewhere_is_read_again(self):
+        self.store.set('delta_links/folder', 'link-1')
+        self.store.flush()
+        # Another process writes a new value with its own version
+        self.db.reference('/').update({'delta_links/folder': 'link-2', 'state_versions/delta_links/folder': 'other'})
+
+        with mock.patch.object(state, 'CHECK_SECONDS', 0):
+            self.assertEqual(self.store.get('delta_links/folder'), 'link-2')
+
+    def test_set_is_local_until_flushed(self):
+        self.store.set('delta_links/folder', 'link-1')
+
+        self.assertEqual(self.db.writes, [])
+        self.assertEqual(self.store.get('delta_links/folder'), 'link-1')
+        self.assertEqual(self.db.reads, [])
+        self.store.pending.set.assert_called()
+
+        self.assertTrue(self.store.flush())
+        write, = self.db.writes
+        self.assertEqual(write['delta_links/folder'], 'link-1')
+        self.assertIn('state_versions/delta_links/folder', write)
+        # Nothing left to write
+        self.assertTrue(self.store.flush())
+        self.assertEqual(len(self.db.writes), 1)
+
+    def test_background_worker_writes_through(self):
+        store = state.StateStore(remote=lambda: self.db, path=self.path)
+
+        store.set('delta_links/folder', 'link-1')
+
+        deadline = time.monotonic() + 5
+        while not self.db.writes and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.db.data['delta_links']['folder'], 'link-1')
+
+    def test_failed_flush_is_retried(self):
+        self.db.failures = 1
+        self.store.set('delta_links/folder', 'link-1')
+
+        self.assertFalse(self.store.flush())
+        self.assertNotIn('delta_links', self.db.data)
+
+        # A restart finds the write still pending in the local file
+        self.assertTrue(self.new_store().flush())
+        self.assertEqual(self.db.data['delta_links']['folder'], 'link-1')
+
+    def test_worker_retries_after_a_failure(self):
+        self.db.failures = 1
+        store = state.StateStore(remote=lambda: self.db, path=self.path)
+
+        with mock.patch.object(state, 'RETRY_SECONDS', 0.05):
+            store.set('delta_links/folder', 'link-1')
+            deadline = time.monotonic() + 5
+            while not self.db.writes and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        self.assertEqual(self.db.data['delta_links']['folder'], 'link-1')
+
+    def test_invalidate_checks_firebase_on_next_get(self):
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-1')
+        self.db.data['refresh_tokens']['hotmail'] = 'token-2'
+        self.db.data['state_versions'] = {'refresh_tokens': {'hotmail': 'new'}}
+
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-1')
+        self.store.invalidate('refresh_tokens/hotmail')
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-2')
+
+    def test_invalidate_keeps_pending_writes(self):
+        self.store.set('refresh_tokens/hotmail', 'token-3')
+
+        self.store.invalidate('refresh_tokens/hotmail')
+
+        self.assertEqual(self.store.get('refresh_tokens/hotmail'), 'token-3')
@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs
+
+import telegram_sender
+from tests.support import serve
+
+
+class TelegramSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(telegram_sender, 'CHAT_INTERVAL', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Answers queued for the next requests, then every request is accepted
+        self.answers = []
+        self.server = serve(self, self.respond)
+
+    def respond(self, method, path, headers, body):
+        if self.answers:
+            return self.answers.pop(0)
+        return 200, {'ok': True}
+
+    def sent(self):
+        '''
+        Returns the texts the fake received, in order
+        '''
+        return [parse_qs(request[3].decode())['text'][0] for request in self.server.requests]
+
+    def test_waits_the_retry_after_telegram_asks_for(self):
+        self.answers = [(429, {'ok': False, 'parameters': {'retry_after': 1}})]
+        sender = telegram_sender.TelegramSender(base_url=self.server.url)
+
+        self.assertTrue(sender.send('hola', chat_id='1').result(timeout=10))
+
+        self.assertEqual(self.sent(), ['hola', 'hola'])
+        first, second = (request[4] for request in self.server.requests)
+        self.assertGreaterEqual(second - first, 1)
+
+    def test_rejected_messages_are_not_retried(self):
+        self.answers = [(400, {'ok': False, 'description': 'Bad Request'})]
+        sender = telegram_sender.TelegramSender(base_url=self.server.url)
+
+        self.assertFalse(sender.send('<b>roto', chat_id='1').result(timeout=10))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_messages_are_sent_in_order(self):
+        sender = telegram_sender.TelegramSender(base_url=self.server.url)
+        texts = [f'mensaje {number}' for number in range(10)]
+
+        futures = [sender.send(text, chat_id='1') for text in texts]
+
+        self.assertTrue(all(future.result(timeout=10) for future in futures))
+        self.assertEqual(self.sent(), texts)
+
+    @mock.patch.object(telegram_sender, 'COALESCE_WAIT', 0.2)
+    def test_coalesces_up_to_the_message_length(self):
+        sender = telegram_sender.TelegramSender(coalesce=True, base_url=self.server.url)
+        texts = [str(number) * 1000 for number in range(10)]
+
+        futures = [sender.send(text, chat_id='1') for text in texts]
+        futures.append(sender.send('otro chat', chat_id='2'))
+
+        self.assertTrue(all(future.result(timeout=10) for future in futures))
+        sent = self.sent()
+        # Four 1000 characters messages and their separators fit, a fifth doesn't
+        self.assertEqual([len(text) for text in sent], [4006, 4006, 2002, 9])
+        self.assertTrue(all(len(text) <= telegram_sender.MAX_MESSAGE_LENGTH for text in sent))
+        self.assertEqual(telegram_sender.SEPARATOR.join(sent[:3]), telegram_sender.SEPARATOR.join(texts))